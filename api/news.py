@@ -0,0 +1,20 @@
+from aiohttp import web
+import aiohttp_session
+
+import codec
+from login import require_login
+from news import load_news_page
+from news import NEWS_PAGE_SIZE
+from news import parse_before
+
+
+@require_login
+async def handle_news(request: web.Request):
+    session = await aiohttp_session.get_session(request)
+    posts, next_cursor = await load_news_page(request, session['uid'], before=parse_before(request),
+                                              limit=NEWS_PAGE_SIZE)
+    response = web.json_response(posts, dumps=codec.dumps_json)
+    if next_cursor:
+        # older posts: /api/news/?before=<X-Next-Cursor>
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
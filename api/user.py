@@ -2,15 +2,27 @@
 
 from aiohttp import web
 
+import codec
 from login import require_login
 from models.user import User
 
+PAGE_SIZE = 20
+
 
 @require_login
 async def handle_user(request: web.Request):
     async with request.app['db_pool'].acquire() as conn:
         offset = int(request.rel_url.query.get('offset', 0))
-        users = await User.filter(conn=conn, offset=offset)
+        after = None
+        if request.rel_url.query.get('after'):
+            try:
+                after = User.parse_cursor(request.rel_url.query['after'])
+            except ValueError:
+                raise web.HTTPBadRequest(reason='bad cursor')
+        users = await User.filter(conn=conn, offset=offset, after=after, limit=PAGE_SIZE + 1)
         # pprint(users)
-        return web.json_response(users)
-
+        response = web.json_response(users and users[:PAGE_SIZE], dumps=codec.dumps_json)
+        if users and len(users) > PAGE_SIZE:
+            # next page: /api/user/?after=<X-Next-Cursor>
+            response.headers['X-Next-Cursor'] = User.make_cursor(users[PAGE_SIZE - 1])
+        return response
@@ -0,0 +1,48 @@
+"""Encode/decode cost per post: stdlib json with utils.default against codec.
+
+    python -m bench.codec --number 100000
+"""
+import argparse
+import datetime
+import json
+import timeit
+
+import codec
+from utils import default
+
+POST = {
+    'author__name': 'Иван Иванов',
+    'id': 1234567,
+    'author_id': 1001004,
+    'text': 'Съешь же ещё этих мягких французских булок, да выпей чаю. ' * 4,
+    'created_at': datetime.datetime(2021, 8, 1, 12, 30, 15),
+    'updated_at': None,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    json_data = json.dumps(POST, default=default)
+    packed = codec.packb(POST)
+    cases = {
+        'json_encode': lambda: json.dumps(POST, default=default),
+        'json_decode': lambda: json.loads(json_data),
+        'codec_packb': lambda: codec.packb(POST),
+        'codec_unpackb': lambda: codec.unpackb(packed),
+        'codec_dumps_json': lambda: codec.dumps_json(POST),
+    }
+    report = {
+        name: round(min(timeit.repeat(call, number=args.number, repeat=3)) / args.number * 1e6, 3)
+        for name, call in cases.items()
+    }
+    report = {f'{name}_us': value for name, value in report.items()}
+    report['json_bytes'] = len(json_data.encode())
+    report['packed_bytes'] = len(packed)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Synthetic users, friendships and posts with production-like distributions.
+
+Names follow a Zipf law, so prefix search meets both crowded and rare prefixes.
+Friends are picked by Pareto distributed popularity, a few users collect most
+of the subscribers (they become pull authors of the news feed), and the number
+of friends per user has a heavy tail as well.
+"""
+import datetime
+from itertools import accumulate
+import random
+from typing import Iterator, List, Tuple
+
+from bench.seed import PASSWORD
+from bench.seed import password_hash
+
+# differs from bench.seed.USERNAME_PREFIX, seed() must not count loaded users as its own
+LOAD_USERNAME_PREFIX = 'load_'
+
+FIRSTNAMES_M = [
+    'Александр', 'Сергей', 'Дмитрий', 'Андрей', 'Алексей', 'Максим', 'Евгений', 'Иван', 'Михаил', 'Артём',
+    'Николай', 'Владимир', 'Павел', 'Роман', 'Олег', 'Кирилл', 'Денис', 'Игорь', 'Антон', 'Юрий',
+    'Виктор', 'Никита', 'Егор', 'Вадим', 'Илья', 'Пётр', 'Григорий', 'Тимур', 'Леонид', 'Фёдор',
+]
+FIRSTNAMES_F = [
+    'Анна', 'Мария', 'Елена', 'Ольга', 'Наталья', 'Екатерина', 'Татьяна', 'Ирина', 'Светлана', 'Юлия',
+    'Анастасия', 'Дарья', 'Марина', 'Людмила', 'Валентина', 'Галина', 'Надежда', 'Виктория', 'Ксения', 'Алина',
+    'Полина', 'Вера', 'Софья', 'Алёна', 'Кристина', 'Любовь', 'Оксана', 'Зоя', 'Яна', 'Эльвира',
+]
+LASTNAME_STEMS = [
+    'Иван', 'Смирн', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков', 'Фёдоров',
+    'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов', 'Козлов', 'Степанов', 'Николаев',
+    'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьёв', 'Борисов', 'Яковлев', 'Григорьев',
+    'Романов', 'Воробьёв', 'Сергеев', 'Кузьмин', 'Фролов', 'Александров', 'Дмитриев', 'Королёв', 'Гусев', 'Киселёв',
+    'Ильин', 'Максимов', 'Поляков', 'Сорокин', 'Виноградов', 'Ковалёв', 'Белов', 'Медведев', 'Антонов', 'Тарасов',
+]
+CITIES = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Нижний Новгород', 'Челябинск',
+          'Самара', 'Омск', 'Ростов-на-Дону', 'Уфа', 'Красноярск', 'Воронеж', 'Пермь', 'Волгоград']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+         'commodo consequat').split()
+INTERESTS = ['музыка', 'кино', 'спорт', 'книги', 'путешествия', 'программирование', 'фотография', 'рыбалка',
+             'шахматы', 'кулинария', 'театр', 'бег', 'велосипед', 'настолки', 'живопись']
+
+
+def zipf_cum_weights(n, s=1.1) -> List[float]:
+    return list(accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+def lastname(stem: str, sex: str) -> str:
+    if stem.endswith(('ов', 'ев', 'ёв', 'ин')):
+        return stem + 'а' if sex == 'f' else stem
+    # stems without suffix, 'Иван' -> 'Иванов'
+    return stem + ('ова' if sex == 'f' else 'ов')
+
+
+class DataGen:
+    """Rows for multi-row INSERTs, ids are assigned here, so friends and posts
+    are generated without reading users back."""
+
+    def __init__(self, users: int, first_user_id=1, first_post_id=1, friends=20, max_friends=5000, posts=5,
+                 days=365, seed=0, username_prefix=LOAD_USERNAME_PREFIX):
+        self.users = users
+        self.first_user_id = first_user_id
+        self.first_post_id = first_post_id
+        self.avg_friends = friends
+        self.max_friends = max_friends
+        self.avg_posts = posts
+        self.days = days
+        self.seed = seed
+        self.username_prefix = username_prefix
+        self.now = datetime.datetime.utcnow().replace(microsecond=0)
+        # (firstname, lastname) by user index, strings are shared with name lists
+        self.names: List[Tuple[str, str]] = []
+
+    @property
+    def user_ids(self) -> range:
+        return range(self.first_user_id, self.first_user_id + self.users)
+
+    def user_rows(self) -> Iterator[tuple]:
+        """(id, username, password, firstname, lastname, sex, city, interest)"""
+        rnd = random.Random(self.seed)
+        first_w = zipf_cum_weights(len(FIRSTNAMES_M))
+        last_w = zipf_cum_weights(len(LASTNAME_STEMS))
+        city_w = zipf_cum_weights(len(CITIES), s=1.5)
+        lastnames = {(stem, sex): lastname(stem, sex) for stem in LASTNAME_STEMS for sex in 'mf'}
+        pwd = password_hash(PASSWORD)
+        self.names = []
+        for uid in self.user_ids:
+            sex = rnd.choice('mf')
+            firstname = rnd.choices(FIRSTNAMES_M if sex == 'm' else FIRSTNAMES_F, cum_weights=first_w)[0]
+            last = lastnames[rnd.choices(LASTNAME_STEMS, cum_weights=last_w)[0], sex]
+            self.names.append((firstname, last))
+            yield (uid, f'{self.username_prefix}u{uid}', pwd, firstname, last, sex,
+                   rnd.choices(CITIES, cum_weights=city_w)[0], ', '.join(rnd.sample(INTERESTS, rnd.randint(1, 3))))
+
+    def friend_rows(self) -> Iterator[tuple]:
+        """(user_id, friend_id), out degree and popularity are Pareto distributed"""
+        rnd = random.Random(self.seed + 1)
+        user_ids = self.user_ids
+        popularity = list(accumulate(rnd.paretovariate(2) for _ in user_ids))
+        # mean of pareto(alpha=2) is 2 * scale
+        scale = self.avg_friends / 2
+        for uid in user_ids:
+            degree = min(self.max_friends, len(user_ids) - 1, round(rnd.paretovariate(2) * scale))
+            friend_ids = set(rnd.choices(user_ids, cum_weights=popularity, k=degree))
+            friend_ids.discard(uid)
+            for friend_id in sorted(friend_ids):
+                yield uid, friend_id
+
+    def post_rows(self) -> Iterator[tuple]:
+        """(id, author_id, text, created_at), post counts are exponentially distributed"""
+        rnd = random.Random(self.seed + 2)
+        post_id = self.first_post_id
+        period = self.days * 24 * 60 * 60
+        for uid in self.user_ids:
+            for _ in range(int(rnd.expovariate(1 / self.avg_posts)) if self.avg_posts else 0):
+                text = ' '.join(rnd.choices(WORDS, k=rnd.randint(5, 40))).capitalize()
+                created_at = self.now - datetime.timedelta(seconds=rnd.randrange(period))
+                yield post_id, uid, text, created_at
+                post_id += 1
+
+    def author_name(self, uid) -> str:
+        firstname, last = self.names[uid - self.first_user_id]
+        return f'{firstname} {last}'
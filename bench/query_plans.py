@@ -0,0 +1,74 @@
+"""Per-call overhead of building filter queries: compiled plans against building SQL on every call.
+
+    python -m bench.query_plans --number 100000
+"""
+import argparse
+import json
+import timeit
+
+from feed import NEWS_FIELDS
+from models.base import split_filter
+from models.friend import Friend
+from models.post import Post
+from models.user import User
+
+
+def user_search():
+    search = 'Ива'
+    filter = {
+        'firstname': {'op': 'like', 'v': f"{search}%"},
+        'lastname': {'op': 'like', 'v': f"{search}%"}
+    }
+    fields = ('id', 'username', 'firstname', 'lastname', 'city', 'sex', 'interest')
+    return User, dict(limit=21, offset=0, current_user_id=1), (fields, True, None), filter
+
+
+def newspage():
+    return Post, dict(limit=20, offset=0), (tuple(NEWS_FIELDS),), dict(post_of_friends=1)
+
+
+def subscribers_chunk():
+    return Friend, dict(limit=1000, offset=0), (('user_id',), 'user_id'), dict(
+        friend_id=1, user_id={'op': 'gt', 'v': 1000})
+
+
+CASES = dict(user_search=user_search, newspage=newspage, subscribers_chunk=subscribers_chunk)
+
+
+def make_call(model, params, args, filter, compiled):
+    fields, *rest = args
+    compile_filter = model._compile_filter if compiled else model._compile_filter.__wrapped__
+
+    def call():
+        filter_shape, filter_values = split_filter(filter)
+        if compiled:
+            plan = compile_filter(fields, filter_shape, *rest)
+        else:
+            plan = compile_filter(model, fields, filter_shape, *rest)
+        return plan.sql, plan.bind(filter_values, **params)
+
+    return call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    report = {}
+    for name, case in CASES.items():
+        model, params, compile_args, filter = case()
+        result = {}
+        for mode, compiled in (('build_per_call', False), ('compiled', True)):
+            call = make_call(model, params, compile_args, filter, compiled)
+            call()
+            seconds = min(timeit.repeat(call, number=args.number, repeat=3))
+            result[f'{mode}_us'] = round(seconds / args.number * 1e6, 3)
+        result['speedup'] = round(result['build_per_call_us'] / result['compiled_us'], 1)
+        report[name] = result
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Friends of friends recommendations on a synthetic graph, no services needed.
+
+Generates a graph with Pareto distributed out degree and popularity (as
+bench/datagen.py does) straight into numpy arrays, builds AdjacencySnapshot and
+times candidates() on a sample of users, compared to a plain python sets
+baseline. Prints build time, memory, per-user latency percentiles and the
+estimated duration of the nightly full run as JSON.
+
+    python -m bench.recommendations --users 1000000 --edges 50000000 --sample 20000 > recs.json
+"""
+import argparse
+from collections import Counter
+import json
+import time
+
+import numpy as np
+
+from bench.hot_paths import percentile
+from recommendations import AdjacencySnapshot
+from recommendations import RECS_SIZE
+
+
+def generate_edges(users, edges, seed=0):
+    """:return: (sources, targets) without self loops and duplicates, ids from 1"""
+    rnd = np.random.default_rng(seed)
+    # pareto(alpha=2) has mean 2 with numpy's shifted (lomax) form + 1
+    degrees = np.round((rnd.pareto(2, users) + 1) * edges / users / 2).astype(np.int64)
+    degrees = np.minimum(degrees, users - 1)
+    sources = np.repeat(np.arange(1, users + 1, dtype=np.int64), degrees)
+    popularity = np.cumsum(rnd.pareto(2, users) + 1)
+    targets = np.searchsorted(popularity, rnd.random(len(sources)) * popularity[-1]).astype(np.int64) + 1
+    keys = np.unique((sources << 32) | targets)
+    sources, targets = keys >> 32, keys & 0xffffffff
+    loops = sources == targets
+    return sources[~loops], targets[~loops].astype(np.uint32)
+
+
+def python_candidates(adjacency, uid, limit=RECS_SIZE):
+    friends = adjacency.get(uid, set())
+    mutual = Counter(candidate for friend_id in friends for candidate in adjacency.get(friend_id, ()))
+    for friend_id in friends:
+        mutual.pop(friend_id, None)
+    mutual.pop(uid, None)
+    return sorted(mutual.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def timings(call, uids) -> list:
+    result = []
+    for uid in uids:
+        started = time.perf_counter()
+        call(uid)
+        result.append(time.perf_counter() - started)
+    return sorted(result)
+
+
+def summary(latencies, users_with_friends) -> dict:
+    total = sum(latencies)
+    return dict(
+        users=len(latencies),
+        p50_ms=round(percentile(latencies, 50) * 1000, 3),
+        p95_ms=round(percentile(latencies, 95) * 1000, 3),
+        p99_ms=round(percentile(latencies, 99) * 1000, 3),
+        users_per_sec=round(len(latencies) / total) if total else None,
+        # single worker, full run over every user with friends
+        full_run_estimate_sec=round(total / len(latencies) * users_with_friends) if latencies else None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--edges', type=int, default=50000000, help='approximate, duplicates are dropped')
+    parser.add_argument('--sample', type=int, default=20000, help='users timed on the snapshot')
+    parser.add_argument('--baseline-sample', type=int, default=200,
+                        help='users timed with python sets, 0 to skip building them')
+    parser.add_argument('--limit', type=int, default=RECS_SIZE)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    sources, targets = generate_edges(args.users, args.edges, seed=args.seed)
+    generate_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    snapshot = AdjacencySnapshot.from_edges(sources, targets, args.users)
+    build_seconds = time.perf_counter() - started
+
+    users_with_friends = len(snapshot.users_with_friends(0, snapshot.nodes))
+    rnd = np.random.default_rng(args.seed + 1)
+    sample = rnd.integers(1, args.users + 1, args.sample).tolist()
+    report = dict(
+        config=dict(users=args.users, edges=args.edges, sample=args.sample, limit=args.limit, seed=args.seed),
+        graph=dict(generate_sec=round(generate_seconds, 2), build_sec=round(build_seconds, 2),
+                   users_with_friends=users_with_friends, **snapshot.stats()),
+        snapshot=summary(timings(lambda uid: snapshot.candidates(uid, args.limit), sample), users_with_friends),
+    )
+
+    if args.baseline_sample:
+        started = time.perf_counter()
+        adjacency = {}
+        for uid in snapshot.users_with_friends(0, snapshot.nodes):
+            adjacency[uid] = set(snapshot.friends(uid).tolist())
+        report['python_sets'] = summary(
+            timings(lambda uid: python_candidates(adjacency, uid, args.limit), sample[:args.baseline_sample]),
+            users_with_friends)
+        report['python_sets']['build_sec'] = round(time.perf_counter() - started, 2)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Small synthetic dataset for benchmarks, inserted with multi-row INSERTs."""
+import hashlib
+import random
+
+import aiomysql
+
+USERNAME_PREFIX = 'bench_'
+PASSWORD = 'bench'
+
+FIRSTNAMES = ['Иван', 'Пётр', 'Анна', 'Мария', 'Олег', 'Ольга', 'Сергей', 'Светлана', 'Алексей', 'Алина']
+LASTNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов', 'Новиков']
+
+INSERT_CHUNK = 1000
+
+
+def password_hash(password: str) -> str:
+    # same as sha() in mysql
+    return hashlib.sha1(password.encode()).hexdigest()
+
+
+async def insert_rows(conn: aiomysql.Connection, table, columns, rows):
+    async with conn.cursor() as cur:
+        for i in range(0, len(rows), INSERT_CHUNK):
+            chunk = rows[i:i + INSERT_CHUNK]
+            placeholders = ','.join(['(' + ','.join(['%s'] * len(columns)) + ')'] * len(chunk))
+            await cur.execute(
+                f"INSERT IGNORE INTO {table}({','.join(columns)}) VALUES {placeholders}",
+                [value for row in chunk for value in row])
+    await conn.commit()
+
+
+async def get_user_ids(conn: aiomysql.Connection):
+    async with conn.cursor() as cur:
+        # '_' of the prefix is a LIKE wildcard
+        await cur.execute("SELECT id FROM user WHERE username LIKE %s ORDER BY id",
+                          (USERNAME_PREFIX.replace('_', r'\_') + '%',))
+        return [uid for (uid,) in await cur.fetchall()]
+
+
+async def seed(pool: aiomysql.Pool, users=10000, friends=20, posts=5, rnd: random.Random = None):
+    """Create `users` users (skipped when already there), with about `friends` friends and `posts` posts each.
+    :return: ids of benchmark users
+    """
+    rnd = rnd or random.Random(0)
+    async with pool.acquire() as conn:
+        user_ids = await get_user_ids(conn)
+        if len(user_ids) >= users:
+            return user_ids[:users]
+
+        pwd = password_hash(PASSWORD)
+        await insert_rows(conn, 'user', ('username', 'password', 'firstname', 'lastname', 'sex', 'city'), [
+            (f'{USERNAME_PREFIX}{i}', pwd, rnd.choice(FIRSTNAMES), rnd.choice(LASTNAMES), rnd.choice('mf'), 'Город')
+            for i in range(users)
+        ])
+        user_ids = await get_user_ids(conn)
+
+        await insert_rows(conn, 'friend', ('user_id', 'friend_id'), [
+            (uid, friend_id)
+            for uid in user_ids
+            for friend_id in rnd.sample(user_ids, min(friends, len(user_ids)))
+            if friend_id != uid
+        ])
+        await insert_rows(conn, 'post', ('author_id', 'text', 'created_at'), [
+            (uid, f'post {n} of {uid}', f'2021-01-01 00:00:{n % 60:02d}')
+            for uid in user_ids
+            for n in range(posts)
+        ])
+    return user_ids
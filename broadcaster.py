@@ -0,0 +1,127 @@
+import asyncio
+from collections import defaultdict
+import logging
+import os
+import time
+from typing import Dict, Iterable
+
+import aiohttp
+from aiohttp import web
+
+import codec
+from metrics import WEBSOCKET_DELIVERY_LAG
+from metrics import WEBSOCKET_DROPPED
+from metrics import WEBSOCKET_ERRORS
+from metrics import WEBSOCKET_SLOW_CONSUMERS
+
+logger = logging.getLogger('broadcaster')
+
+# messages waiting for one websocket, newer ones are dropped when it is full
+WS_QUEUE_SIZE = int(os.getenv('WS_QUEUE_SIZE', 100))
+# posts sent in one frame when a burst is queued
+WS_BATCH_SIZE = int(os.getenv('WS_BATCH_SIZE', 20))
+# consumer is disconnected if a frame is not sent or its queue stays full that long
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 5))
+
+
+class Connection:
+    """Outbound side of a websocket: bounded queue drained by its own sender task."""
+
+    def __init__(self, ws: web.WebSocketResponse, sid):
+        self.ws = ws
+        self.sid = sid
+        self.queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.full_since = None
+        self.task = asyncio.create_task(self._sender())
+
+    def offer(self, fragment: str, received_at: float) -> bool:
+        """Queue json encoded post without waiting.
+        :return: False if message was dropped
+        """
+        try:
+            self.queue.put_nowait((fragment, received_at))
+            self.full_since = None
+            return True
+        except asyncio.QueueFull:
+            WEBSOCKET_DROPPED.inc()
+            now = time.monotonic()
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since > WS_SEND_TIMEOUT:
+                self.disconnect()
+            return False
+
+    def disconnect(self):
+        if self.ws.closed or self.task.done():
+            return
+        logger.debug('disconnect slow consumer %r', self.sid)
+        WEBSOCKET_SLOW_CONSUMERS.inc()
+        self.task.cancel()
+        asyncio.create_task(self.ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b'slow consumer'))
+
+    async def _sender(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < WS_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            frame = '{"type":"posts","data":[' + ','.join(fragment for fragment, _ in batch) + ']}'
+            try:
+                await asyncio.wait_for(self.ws.send_str(frame), WS_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.disconnect()
+                return
+            except ConnectionResetError:
+                WEBSOCKET_ERRORS.inc()
+                logger.debug('Outdated connection %r', self.sid)
+                return
+
+            sent_at = time.monotonic()
+            for _, received_at in batch:
+                WEBSOCKET_DELIVERY_LAG.observe(sent_at - received_at)
+
+    def close(self):
+        self.task.cancel()
+
+
+class Broadcaster:
+    """Delivers posts to websockets of this instance.
+
+    Post is encoded once per message, every socket gets it through its own
+    queue, so a stalled client delays nobody but itself.
+    """
+
+    def __init__(self):
+        # uid -> sid -> Connection
+        self.subscribers: Dict[int, Dict[str, Connection]] = defaultdict(dict)
+
+    def register(self, uid, sid, ws: web.WebSocketResponse) -> Connection:
+        connection = self.subscribers[uid][sid] = Connection(ws, sid)
+        return connection
+
+    def unregister(self, uid, sid):
+        sessions = self.subscribers.get(uid)
+        if sessions:
+            connection = sessions.pop(sid, None)
+            if connection:
+                connection.close()
+        if not sessions:
+            self.subscribers.pop(uid, None)
+
+    def broadcast(self, post: dict, subscriber_ids: Iterable[int]) -> int:
+        """:return: number of sockets the post was queued for"""
+        received_at = time.monotonic()
+        fragment = None
+        queued = 0
+        for subscriber_id in subscriber_ids:
+            for connection in self.subscribers.get(subscriber_id, {}).values():
+                if fragment is None:
+                    fragment = codec.dumps_json(post)
+                queued += connection.offer(fragment, received_at)
+        return queued
+
+    async def close(self):
+        for sessions in self.subscribers.values():
+            for connection in sessions.values():
+                connection.close()
+        self.subscribers.clear()
@@ -0,0 +1,74 @@
+"""Payload encoding.
+
+Internal hops (redis, rabbitmq) use msgpack with a version header, datetimes are msgpack ext types.
+Browser facing json is encoded with orjson, which handles datetimes natively.
+"""
+import datetime
+import json
+import struct
+from typing import Any
+
+import msgpack
+import orjson
+
+VERSION = 1
+CONTENT_TYPE = f'application/vnd.socnet.v{VERSION}+msgpack'
+JSON_CONTENT_TYPE = 'application/json'
+
+# 0xc1 is never used by msgpack and can not start json
+_HEADER = bytes([0xc1, VERSION])
+
+_EXT_DATETIME = 1  # naive datetime, microseconds since epoch
+_EXT_DATE = 2  # proleptic gregorian ordinal
+_EXT_AWARE_DATETIME = 3  # isoformat
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is None:
+            return msgpack.ExtType(_EXT_DATETIME, struct.pack('>q', (obj - _EPOCH) // _MICROSECOND))
+        return msgpack.ExtType(_EXT_AWARE_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(_EXT_DATE, struct.pack('>i', obj.toordinal()))
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not serializable')
+
+
+def _ext_hook(code, data):
+    if code == _EXT_DATETIME:
+        return _EPOCH + struct.unpack('>q', data)[0] * _MICROSECOND
+    if code == _EXT_DATE:
+        return datetime.date.fromordinal(struct.unpack('>i', data)[0])
+    if code == _EXT_AWARE_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def packb(obj: Any) -> bytes:
+    return _HEADER + msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def is_packed(data: bytes) -> bool:
+    return data[:len(_HEADER)] == _HEADER
+
+
+def unpackb(data: bytes) -> Any:
+    """Decode packb output, json is accepted for payloads written before the codec."""
+    if is_packed(data):
+        return msgpack.unpackb(data[len(_HEADER):], ext_hook=_ext_hook, raw=False, strict_map_key=False)
+    return json.loads(data)
+
+
+def decode_message(content_type: str, body: bytes) -> Any:
+    """Decode rabbitmq message body by its content type, None for unknown ones."""
+    if content_type == CONTENT_TYPE:
+        return unpackb(body)
+    if content_type == JSON_CONTENT_TYPE:
+        return json.loads(body)
+    return None
+
+
+def dumps_json(obj: Any) -> str:
+    return orjson.dumps(obj).decode()
@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import os
+import time
+
+from aiohttp import web
+import aiohttp_session
+import aiomysql
+
+from metrics import count_acquire
+from metrics import POOL_ACQUIRE_LATENCY
+
+# session key of (gtid_executed on primary after last write, time of write)
+CONSISTENCY_TOKEN_KEY = 'gtid'
+# after that time replicas are considered caught up with writes of the session
+CONSISTENCY_TOKEN_TTL = float(os.getenv('CONSISTENCY_TOKEN_TTL', 5))
+# how long to wait for replica before falling back to primary
+REPLICA_WAIT_TIMEOUT = float(os.getenv('REPLICA_WAIT_TIMEOUT', 0.1))
+REPLICA_WAIT_INTERVAL = 0.02
+
+
+def has_replica(app: web.Application) -> bool:
+    return app['db_ro_pool'] is not app['db_pool']
+
+
+async def record_write(request: web.Request, conn: aiomysql.Connection = None):
+    """Remember primary position after a write, so that next reads of this session see it."""
+    if not has_replica(request.app):
+        return
+
+    async with contextlib.AsyncExitStack() as stack:
+        if conn is None:
+            conn = await stack.enter_async_context(request.app['db_pool'].acquire())
+        async with conn.cursor() as cur:
+            await cur.execute('SELECT @@GLOBAL.gtid_executed')
+            (gtid_set,) = await cur.fetchone()
+
+    session = await aiohttp_session.get_session(request)
+    session[CONSISTENCY_TOKEN_KEY] = [gtid_set, time.time()]
+
+
+async def get_consistency_token(request: web.Request):
+    session = await aiohttp_session.get_session(request)
+    token = session.get(CONSISTENCY_TOKEN_KEY)
+    if not token:
+        return None
+    gtid_set, written_at = token
+    if time.time() - written_at > CONSISTENCY_TOKEN_TTL:
+        del session[CONSISTENCY_TOKEN_KEY]
+        return None
+    return gtid_set
+
+
+async def wait_for_gtid_set(conn: aiomysql.Connection, gtid_set: str, timeout=REPLICA_WAIT_TIMEOUT) -> bool:
+    """Wait until replica behind conn executed gtid_set.
+    :return: False on timeout
+    """
+    deadline = time.monotonic() + timeout
+    async with conn.cursor() as cur:
+        while True:
+            await cur.execute('SELECT GTID_SUBSET(%s, @@GLOBAL.gtid_executed)', (gtid_set,))
+            (caught_up,) = await cur.fetchone()
+            if caught_up:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(REPLICA_WAIT_INTERVAL)
+
+
+@contextlib.asynccontextmanager
+async def acquire_ro(request: web.Request):
+    """Connection for reading: replica, or primary while replica lags behind writes of the session."""
+    app = request.app
+    pool: aiomysql.pool.Pool = app['db_ro_pool']
+    gtid_set = None
+    if has_replica(app):
+        gtid_set = await get_consistency_token(request)
+
+    count_acquire(request)
+    with POOL_ACQUIRE_LATENCY.labels('db_ro_pool').time():
+        conn = await pool.acquire()
+    if gtid_set:
+        try:
+            caught_up = await wait_for_gtid_set(conn, gtid_set)
+        except BaseException:
+            pool.release(conn)
+            raise
+        if not caught_up:
+            pool.release(conn)
+            pool = app['db_pool']
+            count_acquire(request)
+            with POOL_ACQUIRE_LATENCY.labels('db_pool').time():
+                conn = await pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
@@ -39,6 +39,10 @@ friend:create_index('primary', {type="TREE", unique=true, parts={1, 'unsigned',
 
 
 function batch_insert(space, list)
+    if type(space) ~= 'table' then
+        -- space id or name from a remote call
+        space = box.space[space]
+    end
     box.begin()
         for _, record in ipairs(list) do
             space:replace(record)
@@ -95,3 +99,51 @@ function search_with_friend_and_subscriber(prefix, current_user_id, limit, offse
     return ret
 end
 
+
+
+-- Seeks from `after` = {lastname, firstname, id} of the previous page instead of skipping offset tuples,
+-- stops at the first lastname outside of prefix.
+-- Returns rows of fields with numbers `field_nos` (see user:format()) followed by is_subscriber, is_friend
+-- unless with_flags is false (caller knows the friend graph).
+function search_users(prefix, current_user_id, limit, after, field_nos, with_flags)
+    local limit = limit or 21
+    if with_flags == nil then
+        with_flags = true
+    end
+    local key, iterator = {prefix, prefix}, 'GE'
+    if after ~= nil then
+        key, iterator = after, 'GT'
+    end
+    local ret = {}
+    local _time_to_yield = 0
+    for _, tuple in box.space.user.index.lastname_firstname_id:pairs(key, {iterator=iterator}) do
+        if not string.startswith(tuple[5], prefix, 1, -1) then
+            break
+        end
+        if string.startswith(tuple[4], prefix, 1, -1) then
+            local row = {}
+            for i, field_no in ipairs(field_nos) do
+                local value = tuple[field_no]
+                if value == nil then
+                    value = box.NULL
+                end
+                row[i] = value
+            end
+            if with_flags then
+                table.insert(row, is_subscriber(tuple[1], current_user_id))
+                table.insert(row, is_friend(tuple[1], current_user_id))
+            end
+            table.insert(ret, row)
+            if #ret >= limit then
+                return ret
+            end
+        end
+
+        _time_to_yield = _time_to_yield + 1
+        if _time_to_yield > 1000 then
+            _time_to_yield = 0
+            require('fiber').yield()
+        end
+    end
+    return ret
+end
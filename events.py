@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+import uuid
+
+import aio_pika
+from aiohttp import web
+
+import codec
+
+logger = logging.getLogger('events')
+
+EXCHANGE_NAME = 'events'
+
+_EventHandler = Callable[[web.Application, Dict], Awaitable[None]]
+
+
+def subscribe(app: web.Application, kind: str, handler: _EventHandler):
+    app.setdefault('event_handlers', {}).setdefault(kind, []).append(handler)
+
+
+async def dispatch(app: web.Application, kind: str, event: dict):
+    for handler in app.get('event_handlers', {}).get(kind, []):
+        try:
+            await handler(app, event)
+        except Exception as ex:
+            logger.exception('event handler %r %r: %r', kind, handler, ex)
+
+
+async def publish_event(app: web.Application, kind: str, **event):
+    """Handle event on this instance and broadcast it to the others over rabbit fanout exchange."""
+    await dispatch(app, kind, event)
+    exchange: aio_pika.Exchange = app.get('events_exchange')
+    if exchange is None:
+        return
+    msg = aio_pika.Message(
+        body=codec.packb(dict(event, kind=kind, origin=get_origin(app))),
+        content_type=codec.CONTENT_TYPE)
+    try:
+        await exchange.publish(msg, routing_key='')
+    except Exception as ex:
+        logger.error('publish_event %r: %r', kind, ex)
+
+
+def get_origin(app: web.Application) -> str:
+    # INSTANCE_ID is not required to be unique
+    return app.setdefault('events_origin', uuid.uuid4().hex)
+
+
+async def listen_events(app: web.Application):
+    rabbit: aio_pika.Connection = app.get('rabbit')
+    if not rabbit:
+        return
+
+    logger.debug('listen_events: started')
+    while True:
+        try:
+            channel: aio_pika.Channel = await rabbit.channel()
+            exchange = await channel.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.FANOUT)
+            queue = await channel.declare_queue(exclusive=True)
+            await queue.bind(exchange)
+            app['events_exchange'] = exchange
+
+            async with queue.iterator() as queue_iter:
+                message: aio_pika.IncomingMessage
+                async for message in queue_iter:
+                    async with message.process():
+                        event = codec.decode_message(message.content_type, message.body)
+                        if not event or event.pop('origin', None) == get_origin(app):
+                            continue
+                        await dispatch(app, event.pop('kind', None), event)
+        except asyncio.CancelledError:
+            break
+        except Exception as ex:
+            app.pop('events_exchange', None)
+            logger.error('listen_events: %r', ex)
+            await asyncio.sleep(1)
@@ -0,0 +1,225 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+import uuid
+
+import arq
+
+import codec
+
+NEWS_CACHE_SIZE = 1000
+NEWS_CACHE_TTL = 300
+NEWS_FANOUT_CHUNK_SIZE = 1000
+
+# posts of authors with more subscribers are not pushed to subscribers feeds,
+# they are kept in the author timeline and merged into the feed on read
+NEWS_PULL_THRESHOLD = int(os.getenv('NEWS_PULL_THRESHOLD', 1000))
+NEWS_TIMELINE_SIZE = NEWS_CACHE_SIZE
+NEWS_TIMELINE_TTL = 24 * 60 * 60
+
+# bodies are shared by all feeds and timelines, which keep only post ids
+NEWS_POST_TTL = NEWS_TIMELINE_TTL
+# post fields cached in post:{id}, read by the web app and written by the worker
+NEWS_FIELDS = ['author__name', 'id', 'author_id', 'text', 'created_at', 'updated_at']
+
+PULL_AUTHORS_KEY = 'news:pull_authors'
+# last entry of news lists built from the whole feed, ltrim drops it once older posts are cut off;
+# an empty feed is cached as FEED_END alone, so it is not rebuilt on every read
+FEED_END = 0
+
+# rebuilds of one feed are enqueued at most once per interval (deterministic arq job id)
+NEWS_REBUILD_INTERVAL = int(os.getenv('NEWS_REBUILD_INTERVAL', 60))
+# single-flight lock held by build_news_cache while it queries db
+NEWS_REBUILD_LOCK_TTL = 30
+# how long readers wait for an in-flight rebuild before going to db themselves
+NEWS_REBUILD_WAIT_TIMEOUT = float(os.getenv('NEWS_REBUILD_WAIT_TIMEOUT', 0.5))
+NEWS_REBUILD_POLL_INTERVAL = 0.05
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def news_key(uid):
+    return f'news:{uid}'
+
+
+def follows_key(uid):
+    return f'news:{uid}:follows'
+
+
+def timeline_key(author_id):
+    return f'timeline:{author_id}'
+
+
+def post_key(post_id):
+    return f'post:{post_id}'
+
+
+def rebuild_lock_key(uid):
+    return f'news:{uid}:lock'
+
+
+def post_sort_key(post: dict):
+    return post['created_at'], post['id']
+
+
+def store_posts(pipe, posts):
+    """Put post bodies to the shared store on pipeline."""
+    for post in posts:
+        pipe.setex(post_key(post['id']), NEWS_POST_TTL, codec.packb(post))
+
+
+def parse_post_id(entry):
+    if entry[:1] in (b'{', '{'):
+        # feeds cached before they were normalized
+        return json.loads(entry)['id']
+    return int(entry)
+
+
+class CachedFeed(NamedTuple):
+    posts: List[dict]
+    # no posts older than the cached ones, db is not read past them
+    complete: bool
+    # news list exists, False means cold cache
+    cached: bool
+
+
+def page_ids(feed_ids: List[int], before: tuple = None, limit=NEWS_CACHE_SIZE) -> Optional[List[int]]:
+    """Ids of one feed that may follow `before`, None when the cursor post is not in the feed."""
+    if before is None:
+        return feed_ids[:limit]
+    try:
+        start = feed_ids.index(before[1]) + 1
+    except ValueError:
+        return None
+    return feed_ids[start:start + limit]
+
+
+def merge_posts(feeds, limit=NEWS_CACHE_SIZE):
+    """Merge feeds sorted from newest to oldest, skipping duplicates."""
+    posts = []
+    seen = set()
+    for post in heapq.merge(*feeds, key=post_sort_key, reverse=True):
+        if post['id'] in seen:
+            continue
+        seen.add(post['id'])
+        posts.append(post)
+        if len(posts) >= limit:
+            break
+    return posts
+
+
+async def read_feed(redis: arq.ArqRedis, uid, limit=NEWS_CACHE_SIZE, before: tuple = None,
+                    load_posts: Callable[[List[int]], Awaitable[List[dict]]] = None) -> CachedFeed:
+    """Pushed feed of uid merged with timelines of followed pull authors.
+    Only bodies of posts that may get on the page are fetched.
+    :param before: (created_at, id) of the last post of previous page, older posts are returned
+    :param load_posts: loads posts missing in the shared store by ids, they are stored back
+    """
+    pipe = redis.pipeline()
+    pipe.lrange(news_key(uid), 0, -1)
+    pipe.sinter(follows_key(uid), PULL_AUTHORS_KEY)
+    news_entries, pull_authors = await pipe.execute()
+
+    news_ids = list(map(parse_post_id, news_entries))
+    complete = bool(news_ids) and news_ids[-1] == FEED_END
+    if complete:
+        news_ids.pop()
+    feeds_ids = [news_ids]
+    if pull_authors:
+        pipe = redis.pipeline()
+        for author_id in pull_authors:
+            pipe.lrange(timeline_key(int(author_id)), 0, NEWS_TIMELINE_SIZE - 1)
+        for timeline_entries in await pipe.execute():
+            feeds_ids.append(list(map(parse_post_id, timeline_entries)))
+
+    pages = [page_ids(feed_ids, before, limit) for feed_ids in feeds_ids]
+    unknown = [feed_ids[-1] for feed_ids, page in zip(feeds_ids, pages) if page is None and feed_ids]
+    if unknown:
+        # cursor is from db or another feed: feeds ending with newer posts than it are skipped whole
+        oldest = await fetch_posts(redis, unknown, load_posts)
+        for i, feed_ids in enumerate(feeds_ids):
+            if pages[i] is None:
+                last = oldest.get(feed_ids[-1]) if feed_ids else None
+                pages[i] = feed_ids if last is None or post_sort_key(last) < before else []
+    feeds_ids = pages
+
+    post_ids = list({post_id for feed_ids in feeds_ids for post_id in feed_ids})
+    if not post_ids:
+        return CachedFeed([], complete, bool(news_entries))
+
+    posts = await fetch_posts(redis, post_ids, load_posts)
+    feeds = [[posts[post_id] for post_id in feed_ids
+              if post_id in posts and (before is None or post_sort_key(posts[post_id]) < before)]
+             for feed_ids in feeds_ids]
+    return CachedFeed(merge_posts(feeds, limit=limit), complete, bool(news_entries))
+
+
+async def fetch_posts(redis: arq.ArqRedis, post_ids: List[int],
+                      load_posts: Callable[[List[int]], Awaitable[List[dict]]] = None) -> Dict[int, dict]:
+    """Post bodies from the shared store by id.
+    :param load_posts: loads posts missing in the store by ids, they are stored back
+    """
+    posts = {}
+    missing_ids = []
+    for post_id, post_data in zip(post_ids, await redis.mget(*map(post_key, post_ids))):
+        if post_data is None or not codec.is_packed(post_data):
+            # json bodies stored before codec have string dates, reload them
+            missing_ids.append(post_id)
+        else:
+            posts[post_id] = codec.unpackb(post_data)
+
+    if missing_ids and load_posts is not None:
+        loaded = await load_posts(missing_ids)
+        pipe = redis.pipeline()
+        store_posts(pipe, loaded)
+        await pipe.execute()
+        posts.update((post['id'], post) for post in loaded)
+    return posts
+
+
+async def enqueue_rebuild(redis: arq.ArqRedis, uid):
+    """Enqueue build_news_cache for uid unless the same rebuild is already queued.
+    :return: arq job or None if deduplicated
+    """
+    bucket = int(time.time() // NEWS_REBUILD_INTERVAL)
+    return await redis.enqueue_job(
+        'build_news_cache', user_id=uid, _job_id=f'build_news_cache:{uid}:{bucket}')
+
+
+async def acquire_rebuild_lock(redis: arq.ArqRedis, uid):
+    """:return: lock token or None if feed of uid is being rebuilt already"""
+    token = uuid.uuid4().hex
+    if await redis.set(rebuild_lock_key(uid), token, expire=NEWS_REBUILD_LOCK_TTL, exist=redis.SET_IF_NOT_EXIST):
+        return token
+    return None
+
+
+async def release_rebuild_lock(redis: arq.ArqRedis, uid, token):
+    # lock may have expired and been taken by another rebuild
+    await redis.eval(RELEASE_LOCK_SCRIPT, keys=[rebuild_lock_key(uid)], args=[token])
+
+
+async def wait_for_rebuild(redis: arq.ArqRedis, uid, timeout=NEWS_REBUILD_WAIT_TIMEOUT):
+    """Wait for in-flight rebuild of uid feed.
+    :return: True if feed was rebuilt (empty one too, see FEED_END),
+        False if there is no rebuild or it did not finish in time
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        pipe = redis.pipeline()
+        pipe.exists(rebuild_lock_key(uid))
+        pipe.exists(news_key(uid))
+        locked, cached = await pipe.execute()
+        if cached:
+            return True
+        if not locked or time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(NEWS_REBUILD_POLL_INTERVAL)
@@ -0,0 +1,219 @@
+"""In-process friend graph for relationship checks.
+
+Edges user_id -> friend_id of `friend` table are kept in CSR form: for every
+user id `offsets[uid]:offsets[uid + 1]` is the slice of sorted neighbour ids,
+once for out-edges (friends) and once for in-edges (followers). Changes arrive
+by `friend_changed` events and live in a small overlay until the graph is
+reloaded from db.
+"""
+import asyncio
+from collections import defaultdict
+import logging
+import os
+import time
+from typing import Dict, List, Set, Tuple
+
+from aiohttp import web
+import aiomysql
+import numpy as np
+
+from events import subscribe
+
+logger = logging.getLogger('friend_graph')
+
+FRIEND_GRAPH = os.getenv('FRIEND_GRAPH', '') in ('1', 'true', 'yes')
+LOAD_CHUNK_SIZE = 100000
+# graph is reloaded when the overlay grows larger
+OVERLAY_MAX_EDGES = int(os.getenv('FRIEND_GRAPH_OVERLAY_MAX', 100000))
+
+
+def _id_dtype(max_id):
+    return np.uint32 if max_id < 2 ** 32 else np.uint64
+
+
+class CSR:
+    """Sorted adjacency lists of all nodes packed in two numpy arrays."""
+
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray):
+        self.offsets = offsets
+        self.targets = targets
+
+    def neighbours(self, node) -> np.ndarray:
+        if node + 1 >= len(self.offsets):
+            return self.targets[0:0]
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def has_edge(self, source, target) -> bool:
+        if source + 1 >= len(self.offsets):
+            return False
+        lo, hi = int(self.offsets[source]), int(self.offsets[source + 1])
+        i = lo + int(np.searchsorted(self.targets[lo:hi], target))
+        return i < hi and int(self.targets[i]) == target
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.targets.nbytes
+
+    def transpose(self) -> 'CSR':
+        """Reversed edges, built as from_edges does with ends swapped."""
+        sources = np.repeat(np.arange(len(self.offsets) - 1, dtype=self.targets.dtype), np.diff(self.offsets))
+        return CSR.from_edges(self.targets, sources, len(self.offsets) - 2)
+
+    @classmethod
+    def from_edges(cls, sources: np.ndarray, targets: np.ndarray, max_id) -> 'CSR':
+        """:param sources, targets: edge ends in any order"""
+        order = np.lexsort((targets, sources))
+        offsets = np.zeros(max_id + 2, dtype=np.int64)
+        np.cumsum(np.bincount(sources.astype(np.int64), minlength=max_id + 1), out=offsets[1:])
+        return cls(offsets, targets[order].astype(_id_dtype(max_id)))
+
+
+class FriendGraph:
+
+    def __init__(self):
+        self._out = CSR(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint32))
+        self._in = self._out
+        # edges added or removed since load, by source and by target
+        self._added_out: Dict[int, Set[int]] = defaultdict(set)
+        self._added_in: Dict[int, Set[int]] = defaultdict(set)
+        self._removed_out: Dict[int, Set[int]] = defaultdict(set)
+        self._removed_in: Dict[int, Set[int]] = defaultdict(set)
+        self.overlay_size = 0
+        # changes received while loading, replayed on the loaded graph
+        self._pending: List[Tuple[int, int, bool]] = []
+        self.loading = False
+        self.ready = False
+
+    def load(self, edges: List[Tuple[int, int]], max_id):
+        edges = np.array(edges, dtype=_id_dtype(max_id)).reshape(-1, 2)
+        out = CSR.from_edges(edges[:, 0], edges[:, 1], max_id)
+        self._swap(out, out.transpose())
+
+    def _swap(self, out: CSR, in_: CSR):
+        self._out, self._in = out, in_
+        for overlay in (self._added_out, self._added_in, self._removed_out, self._removed_in):
+            overlay.clear()
+        self.overlay_size = 0
+
+    def has_edge(self, user_id, friend_id) -> bool:
+        if friend_id in self._added_out.get(user_id, ()):
+            return True
+        if friend_id in self._removed_out.get(user_id, ()):
+            return False
+        return self._out.has_edge(user_id, friend_id)
+
+    def is_friend(self, user_id, current_user_id) -> bool:
+        """current user follows user_id"""
+        return self.has_edge(current_user_id, user_id)
+
+    def is_subscriber(self, user_id, current_user_id) -> bool:
+        """user_id follows current user"""
+        return self.has_edge(user_id, current_user_id)
+
+    @staticmethod
+    def _merge(csr: CSR, node, added: Dict[int, Set[int]], removed: Dict[int, Set[int]]) -> List[int]:
+        ids = csr.neighbours(node).tolist()
+        if node not in added and node not in removed:
+            return ids
+        return sorted(set(ids).union(added.get(node, ())).difference(removed.get(node, ())))
+
+    def friends(self, uid) -> List[int]:
+        return self._merge(self._out, uid, self._added_out, self._removed_out)
+
+    def followers(self, uid) -> List[int]:
+        return self._merge(self._in, uid, self._added_in, self._removed_in)
+
+    def subscribers(self, uid) -> List[int]:
+        """Followers not followed back, as User.get_subscribers"""
+        return [follower for follower in self.followers(uid) if not self.has_edge(uid, follower)]
+
+    @staticmethod
+    def _discard(overlay: Dict[int, Set[int]], key, value) -> int:
+        values = overlay.get(key)
+        if not values or value not in values:
+            return 0
+        values.discard(value)
+        if not values:
+            del overlay[key]
+        return 1
+
+    def apply(self, user_id, friend_id, added: bool):
+        user_id, friend_id = int(user_id), int(friend_id)
+        if self.loading:
+            self._pending.append((user_id, friend_id, added))
+
+        self.overlay_size -= self._discard(self._added_out, user_id, friend_id)
+        self._discard(self._added_in, friend_id, user_id)
+        self.overlay_size -= self._discard(self._removed_out, user_id, friend_id)
+        self._discard(self._removed_in, friend_id, user_id)
+        if added != self._out.has_edge(user_id, friend_id):
+            out, in_ = (self._added_out, self._added_in) if added else (self._removed_out, self._removed_in)
+            out[user_id].add(friend_id)
+            in_[friend_id].add(user_id)
+            self.overlay_size += 1
+
+    def stats(self) -> dict:
+        edges = len(self._out.targets)
+        nbytes = self._out.nbytes + self._in.nbytes
+        return dict(edges=edges, overlay=self.overlay_size, bytes=nbytes,
+                    bytes_per_edge=round(nbytes / edges, 2) if edges else None)
+
+    async def load_from_db(self, pool: aiomysql.pool.Pool):
+        started = time.perf_counter()
+        self.loading = True
+        try:
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('SELECT COALESCE(MAX(id), 0) FROM user')
+                    (max_id,) = await cur.fetchone()
+                # edge ends go straight to numpy chunks, tuples of a whole table would take GBs
+                chunks = []
+                async with conn.cursor(aiomysql.SSCursor) as cur:
+                    await cur.execute('SELECT user_id, friend_id FROM friend')
+                    while True:
+                        chunk = await cur.fetchmany(LOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        # users registered after max(id) was read
+                        max_id = max(max_id, max(max(edge) for edge in chunk))
+                        chunks.append(np.array(chunk, dtype=_id_dtype(max_id)))
+            edges = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=_id_dtype(max_id))
+            del chunks
+            # sorting millions of edges takes seconds, numpy releases GIL and the loop keeps serving
+            loop = asyncio.get_event_loop()
+            out = await loop.run_in_executor(None, CSR.from_edges, edges[:, 0], edges[:, 1], max_id)
+            del edges
+            in_ = await loop.run_in_executor(None, out.transpose)
+            self._swap(out, in_)
+        finally:
+            self.loading = False
+        pending, self._pending = self._pending, []
+        for user_id, friend_id, added in pending:
+            self.apply(user_id, friend_id, added)
+        self.ready = True
+        logger.info('friend graph loaded: %r in %.2fs', self.stats(), time.perf_counter() - started)
+
+
+async def handle_friend_changed(app: web.Application, event: dict):
+    graph: FriendGraph = app['friend_graph']
+    graph.apply(event['user_id'], event['friend_id'], event.get('added', True))
+    if graph.overlay_size > OVERLAY_MAX_EDGES and not graph.loading:
+        app['tasks'].append(asyncio.create_task(graph.load_from_db(app['db_ro_pool'])))
+
+
+def setup_friend_graph(app: web.Application):
+    """Load graph in background, relationship checks go to db until it is ready."""
+    graph = app['friend_graph'] = FriendGraph()
+    subscribe(app, 'friend_changed', handle_friend_changed)
+
+    async def load(_app):
+        try:
+            await graph.load_from_db(_app['db_ro_pool'])
+        except Exception as ex:
+            logger.exception('friend graph: %r', ex)
+
+    async def start(_app):
+        _app['tasks'].append(asyncio.create_task(load(_app)))
+
+    app.on_startup.append(start)
+    return graph
@@ -5,16 +5,29 @@ import aiohttp_jinja2
 import aiohttp_session
 import aiomysql
 
+from db_router import record_write
+from events import publish_event
+from feed import enqueue_rebuild
 from models.user import User
 
 _WebHandler = Callable[[web.Request], Awaitable[web.StreamResponse]]
 
+SESSION_COOKIE_KEY = 'socnet_session_cookie'
+
 
 def require_login(func: _WebHandler) -> _WebHandler:
     func.__require_login__ = True  # type: ignore
     return func
 
 
+def get_session_cookie(request: web.Request) -> str:
+    """Raw session cookie to pass to chat and counters services."""
+    if SESSION_COOKIE_KEY not in request:
+        storage: aiohttp_session.AbstractStorage = request[aiohttp_session.STORAGE_KEY]
+        request[SESSION_COOKIE_KEY] = storage.load_cookie(request)
+    return request[SESSION_COOKIE_KEY]
+
+
 async def username_ctx_processor(request: web.Request) -> Dict[str, Any]:
     # Jinja2 context processor
     session = await aiohttp_session.get_session(request)
@@ -26,7 +39,12 @@ async def username_ctx_processor(request: web.Request) -> Dict[str, Any]:
 @web.middleware
 async def check_login(request: web.Request,
                       handler: _WebHandler) -> web.StreamResponse:
+    if (isinstance(request.match_info.route.resource, web.StaticResource)
+            or getattr(handler, "__static__", False)):
+        return await handler(request)
+
     is_require_login = getattr(handler, "__require_login__", False)
+    # loaded once, aiohttp_session keeps it in request for handlers and context processors
     session = await aiohttp_session.get_session(request)
     username = session.get("username")
     if is_require_login:
@@ -81,7 +99,7 @@ async def handle_login_post(request: web.Request):
             session["uid"] = uid
 
             if request.app.get('arq_pool'):
-                await request.app['arq_pool'].enqueue_job('build_news_cache', user_id=uid)
+                await enqueue_rebuild(request.app['arq_pool'], uid)
 
             next_location = form.get('next')
             location = next_location or request.app.router['index'].url_for()
@@ -124,9 +142,19 @@ async def validate_register(form, app):
 
         uid = await User.from_dict(dict(form, id=None)).save(conn=conn)
 
+    await publish_event(app, 'user_changed', id=uid, lastname=form.get('lastname'), firstname=form['firstname'])
     return uid, ''
 
 
+async def handle_user_changed(app, event):
+    """Drop cached row of changed user on every instance.
+
+    validate_register is the only writer of user rows (User.save can not update yet), so it is the only
+    publisher; entries written by other means (bench loaders, manual SQL) expire by USER_CACHE_TTL.
+    """
+    User.cache.invalidate(event['id'])
+
+
 @aiohttp_jinja2.template('register.jinja2')
 async def handle_register(request: web.Request):
     data = await request.post()
@@ -142,6 +170,7 @@ async def handle_register(request: web.Request):
             session = await aiohttp_session.get_session(request)
             session["username"] = form["username"]
             session["uid"] = uid
+            await record_write(request)
 
             location = request.app.router['index'].url_for()
             raise web.HTTPFound(location=location)
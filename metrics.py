@@ -0,0 +1,194 @@
+import contextlib
+import functools
+import logging
+import time
+
+from aiohttp import web
+import arq
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import generate_latest
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily
+
+from models.user import User
+from zipkin_monkeypatch import get_route
+
+logger = logging.getLogger('metrics')
+
+REQUEST_LATENCY = Histogram(
+    'socnet_http_request_duration_seconds', 'Handler latency by canonical route',
+    ['method', 'route', 'status'])
+BACKEND_LATENCY = Histogram(
+    'socnet_backend_call_duration_seconds', 'Latency of redis, tarantool and search index calls',
+    ['backend', 'call'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+POOL_ACQUIRE_LATENCY = Histogram(
+    'socnet_db_pool_acquire_duration_seconds', 'Time waiting for a pool connection',
+    ['pool'], buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5))
+JOB_DURATION = Histogram(
+    'socnet_job_duration_seconds', 'arq job duration', ['job', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+CONNECTIONS_PER_REQUEST = Histogram(
+    'socnet_db_connections_per_request', 'Pool connections acquired for reading by one request',
+    ['route'], buckets=(0, 1, 2, 3, 4, 6, 8))
+TEMPLATE_RENDER_LATENCY = Histogram(
+    'socnet_template_render_duration_seconds', 'Render time of pages and of cache missed fragments', ['template'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25))
+QUEUE_DEPTH = Gauge('socnet_arq_queue_depth', 'Jobs waiting in arq queue')
+WEBSOCKET_ERRORS = Counter('socnet_websocket_send_errors_total', 'Failed websocket sends')
+WEBSOCKET_DROPPED = Counter('socnet_websocket_dropped_messages_total', 'Posts dropped for full websocket queues')
+WEBSOCKET_SLOW_CONSUMERS = Counter('socnet_websocket_slow_consumers_total', 'Websockets closed for being slow')
+WEBSOCKET_DELIVERY_LAG = Histogram(
+    'socnet_websocket_delivery_lag_seconds', 'Time from receiving a post on instance to sending it to websocket',
+    buckets=(.0005, .001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5))
+
+
+@contextlib.contextmanager
+def timed(backend, call):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        BACKEND_LATENCY.labels(backend, call).observe(time.perf_counter() - started)
+
+
+def timed_job(func):
+    """Wrap arq job function to observe its duration, keeps the job name."""
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = await func(ctx, *args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            JOB_DURATION.labels(func.__name__, status).observe(time.perf_counter() - started)
+    return wrapper
+
+
+def count_acquire(request: web.Request):
+    request['db_acquires'] = request.get('db_acquires', 0) + 1
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if isinstance(response, web.WebSocketResponse):
+            # connection lifetime is not a latency
+            status = None
+        return response
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        if status is not None:
+            route = get_route(request) or 'unmatched'
+            REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.perf_counter() - started)
+            if 'db_acquires' in request:
+                CONNECTIONS_PER_REQUEST.labels(route).observe(request['db_acquires'])
+
+
+class StateCollector:
+    """Pools, websockets and caches of web app or arq worker ctx, read at scrape time."""
+
+    POOLS = ('db_pool', 'db_ro_pool')
+
+    def __init__(self, state):
+        self._state = state
+
+    def collect(self):
+        size = GaugeMetricFamily('socnet_db_pool_size', 'Open connections', labels=['pool'])
+        free = GaugeMetricFamily('socnet_db_pool_free', 'Idle connections', labels=['pool'])
+        maxsize = GaugeMetricFamily('socnet_db_pool_maxsize', 'Pool limit', labels=['pool'])
+        waiting = GaugeMetricFamily('socnet_db_pool_waiting', 'Coroutines waiting for connection', labels=['pool'])
+        for name in self.POOLS:
+            pool = self._state.get(name)
+            if pool is None or (name == 'db_ro_pool' and pool is self._state.get('db_pool')):
+                continue
+            size.add_metric([name], pool.size)
+            free.add_metric([name], pool.freesize)
+            maxsize.add_metric([name], pool.maxsize)
+            waiting.add_metric([name], len(getattr(pool._cond, '_waiters', None) or ()))
+        yield from (size, free, maxsize, waiting)
+
+        subscribers = self._state.get('news_subscribers')
+        if subscribers is not None:
+            yield GaugeMetricFamily('socnet_websockets', 'Open news websockets',
+                                    value=sum(map(len, subscribers.values())))
+
+        search_index = self._state.get('search_index')
+        if search_index is not None and search_index.ready:
+            stats = search_index.stats()
+            yield GaugeMetricFamily('socnet_search_index_items', 'Users in search index', value=stats['items'])
+            yield GaugeMetricFamily('socnet_search_index_bytes', 'Search index memory estimate',
+                                    value=stats['bytes'])
+
+        graph = self._state.get('friend_graph')
+        if graph is not None and graph.ready:
+            stats = graph.stats()
+            yield GaugeMetricFamily('socnet_friend_graph_edges', 'Edges in friend graph', value=stats['edges'])
+            yield GaugeMetricFamily('socnet_friend_graph_overlay', 'Edges changed since graph load',
+                                    value=stats['overlay'])
+            yield GaugeMetricFamily('socnet_friend_graph_bytes', 'Friend graph arrays size', value=stats['bytes'])
+
+        snapshot = self._state.get('recs_snapshot')
+        if snapshot is not None:
+            stats = snapshot.stats()
+            yield GaugeMetricFamily('socnet_recs_snapshot_edges', 'Edges in recommendations snapshot',
+                                    value=stats['edges'])
+            yield GaugeMetricFamily('socnet_recs_snapshot_overlay', 'Users with friends changed since snapshot load',
+                                    value=stats['overlay'])
+            yield GaugeMetricFamily('socnet_recs_snapshot_bytes', 'Recommendations snapshot arrays size',
+                                    value=stats['bytes'])
+
+        caches = [('user', User.cache)]
+        fragments = self._state.get('fragment_cache')
+        if fragments is not None:
+            caches.append(('fragment', fragments.cache))
+        for name, cache in caches:
+            stats = cache.stats()
+            for key in ('hits', 'misses', 'evictions'):
+                yield CounterMetricFamily(f'socnet_{name}_cache_{key}', f'{name.capitalize()} cache {key}',
+                                          value=stats[key])
+            for key in ('items', 'bytes'):
+                yield GaugeMetricFamily(f'socnet_{name}_cache_{key}', f'{name.capitalize()} cache {key}',
+                                        value=stats[key])
+
+
+def setup_state_collector(state):
+    collector = StateCollector(state)
+    REGISTRY.register(collector)
+    return collector
+
+
+async def update_queue_depth(redis: arq.ArqRedis):
+    try:
+        with timed('redis', 'zcard'):
+            QUEUE_DEPTH.set(await redis.zcard(arq.constants.default_queue_name))
+    except Exception as ex:
+        logger.error('update_queue_depth: %r', ex)
+
+
+async def handle_metrics(request: web.Request):
+    if request.app.get('arq_pool'):
+        await update_queue_depth(request.app['arq_pool'])
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def setup_metrics(app: web.Application):
+    collector = setup_state_collector(app)
+
+    async def unregister(_app):
+        REGISTRY.unregister(collector)
+
+    app.on_cleanup.append(unregister)
+    app.middlewares.append(metrics_middleware)
+    app.router.add_get('/metrics', handle_metrics, name='metrics')
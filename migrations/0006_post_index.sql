@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS `post_author_id_created_at_id_index` ON `post`(`author_id`, `created_at`, `id`);
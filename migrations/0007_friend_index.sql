@@ -0,0 +1,3 @@
+CREATE INDEX IF NOT EXISTS `friend_friend_id_user_id_index` ON `friend`(`friend_id`, `user_id`);
+-- the composite index serves friend_ibfk_2 and lookups by friend_id alone
+DROP INDEX IF EXISTS `friend_id` ON `friend`;
@@ -1,3 +1,7 @@
+import base64
+import json
+from typing import List, NamedTuple, Tuple
+
 import aiomysql
 
 
@@ -17,22 +21,47 @@ class Model:
         return f'<{self.__class__.__name__} {self.id}>'
 
     @classmethod
-    async def get_by_id(cls, _id, conn, fields: list = None):
+    def get_by_id_query(cls, _id, fields: list = None) -> Tuple[str, dict]:
         if not fields:
             fields = cls._default_fields
         else:
             for field in fields:
                 assert hasattr(cls, field), f'unknown field: {field}'
+        return f"SELECT {','.join(fields)} FROM {cls._table_name} WHERE id = %(id)s", dict(id=_id)
 
+    @classmethod
+    async def get_by_id(cls, _id, conn, fields: list = None):
         async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(f"SELECT {','.join(fields)} FROM {cls._table_name} WHERE id = %(id)s",
-                              dict(id=_id))
+            await cur.execute(*cls.get_by_id_query(_id, fields))
             result = await cur.fetchone()
             if not result:
                 return None
             return cls.from_dict(result)
 
 
+class Batch:
+    """Queries sent to db in one round trip as a multi-statement query, result sets are read with nextset()."""
+
+    def __init__(self):
+        self._queries = []
+
+    def add(self, sql, params: dict = None) -> int:
+        """:return: index of the query rows in execute() result"""
+        self._queries.append((sql, params))
+        return len(self._queries) - 1
+
+    async def execute(self, conn) -> List[list]:
+        """:return: rows of every query, in order of adding"""
+        if not self._queries:
+            return []
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(';\n'.join(cur.mogrify(sql, params) for sql, params in self._queries))
+            results = [list(await cur.fetchall())]
+            while await cur.nextset():
+                results.append(list(await cur.fetchall()))
+        return results
+
+
 def make_param_name(existing_params, param):
     i = 1
     param_name = param
@@ -43,6 +72,46 @@ def make_param_name(existing_params, param):
     return param_name
 
 
+class QueryPlan(NamedTuple):
+    """SQL text compiled once per query shape, only values are bound on each call."""
+    sql: str
+    # names of parameters for filter values, in filter order
+    filter_params: Tuple[str, ...] = ()
+
+    def bind(self, filter_values=(), **params) -> dict:
+        params.update(zip(self.filter_params, filter_values))
+        return params
+
+
+def split_filter(filter: dict = None):
+    """Split filter to its shape ((field, op), ...), which is hashable, and values."""
+    if not filter:
+        return (), ()
+    shape = []
+    values = []
+    for field, value in filter.items():
+        op = 'eq'
+        if isinstance(value, dict):
+            op = value['op']
+            value = value['v']
+        shape.append((field, op))
+        values.append(value)
+    return tuple(shape), tuple(values)
+
+
+def compile_where(cls, filter_shape: tuple, param_names: set, column=None):
+    """Conditions and parameter names for filter shape made by split_filter."""
+    where = []
+    filter_params = []
+    for field, op in filter_shape:
+        assert hasattr(cls, field), f'unknown field: {field} in filter'
+        filter_name = make_param_name(param_names, f"{field}_filter")
+        param_names.add(filter_name)
+        where.append(f"{column(field) if column else field} {FILTER_OP[op]} %({filter_name})s")
+        filter_params.append(filter_name)
+    return where, tuple(filter_params)
+
+
 FILTER_OP = {
     'eq': '=',
     'ne': '!=',
@@ -50,5 +119,26 @@ FILTER_OP = {
     'le': '<=',
     'gt': '>',
     'ge': '>=',
-    'like': 'like'
+    'like': 'like',
+    'in': 'in',
 }
+
+
+def encode_cursor(values) -> str:
+    """Pack the sort key of the last row of a page into an opaque url-safe token."""
+    raw = json.dumps(list(values), separators=(',', ':'), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """Unpack token made by encode_cursor.
+    :raise ValueError: if cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except ValueError as ex:
+        raise ValueError(f'bad cursor: {cursor!r}') from ex
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError(f'bad cursor: {cursor!r}')
+    return values
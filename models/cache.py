@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import sys
+import time
+
+
+def sizeof(value) -> int:
+    """Approximate memory used by value, one level deep for containers."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(map(sys.getsizeof, value))
+    return size
+
+
+class LRUCache:
+    """In-process LRU cache bounded by approximate size in bytes, entries expire after ttl seconds."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=60.0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expire_at, size, value)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > self._clock()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expire_at, _, value = item
+        if expire_at <= self._clock():
+            self.invalidate(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.invalidate(key)
+        size = sizeof(key) + sizeof(value)
+        if size > self.max_bytes:
+            return
+        self._data[key] = (self._clock() + self.ttl, size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return dict(items=len(self._data), bytes=self.bytes, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
@@ -1,8 +1,11 @@
+import functools
+
 import aiomysql
 
-from .base import FILTER_OP
-from .base import make_param_name
+from .base import compile_where
 from .base import Model
+from .base import QueryPlan
+from .base import split_filter
 
 
 class Friend(Model):
@@ -34,39 +37,82 @@ class Friend(Model):
         )
 
     @classmethod
-    async def filter(cls, conn, filter: dict = None, limit=20, offset=0, fields: list = None):
-        if not fields:
-            fields = cls._default_fields
-        else:
-            for field in fields:
-                assert hasattr(cls, field), f'unknown field: {field}'
-
-        query_params = dict(limit=int(limit), offset=int(offset))
+    async def filter(cls, conn, filter: dict = None, limit=20, offset=0, fields: list = None, order_by='user_id'):
+        filter_shape, filter_values = split_filter(filter)
+        plan = cls._compile_filter(tuple(fields or cls._default_fields), filter_shape, order_by)
+
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(plan.sql, plan.bind(filter_values, limit=int(limit), offset=int(offset)))
+            result = await cur.fetchall()
+            return result or []
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_filter(cls, fields: tuple, filter_shape: tuple, order_by: str):
+        for field in fields:
+            assert hasattr(cls, field), f'unknown field: {field}'
+        assert hasattr(cls, order_by), f'unknown field: {order_by} in order_by'
+
         where_sql = ''
-        where = []
+        where, filter_params = compile_where(cls, filter_shape, {'limit', 'offset'})
+        if where:
+            where_sql = f"WHERE {' AND '.join(where)}"
+
+        return QueryPlan(
+            sql=(f"SELECT "
+                 f"{','.join(fields)}"
+                 f" FROM {cls._table_name} "
+                 f" {where_sql} "
+                 f" ORDER BY {order_by} "
+                 f"LIMIT %(limit)s OFFSET %(offset)s"),
+            filter_params=filter_params)
 
-        if filter:
-            for field, value in filter.items():
-                assert hasattr(cls, field), f'unknown field: {field} in filter'
-                op = '='
-                if isinstance(value, dict):
-                    op = FILTER_OP[value['op']]
-                    value = value['v']
+    @classmethod
+    async def count(cls, conn, filter: dict = None, limit: int = None):
+        """:param limit: stop counting at limit, reads at most that many index entries"""
+        filter_shape, filter_values = split_filter(filter)
+        plan = cls._compile_count(filter_shape, limit is not None)
 
-                filter_name = make_param_name(query_params, f"{field}_filter")
-                where.append(f"{field} {op} %({filter_name})s")
-                query_params[filter_name] = value
+        async with conn.cursor() as cur:
+            await cur.execute(plan.sql, plan.bind(filter_values, limit=limit))
+            (result,) = await cur.fetchone()
+            return result
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_count(cls, filter_shape: tuple, bounded=False):
+        where_sql = ''
+        where, filter_params = compile_where(cls, filter_shape, {'limit'})
         if where:
             where_sql = f"WHERE {' AND '.join(where)}"
+        if bounded:
+            return QueryPlan(
+                sql=f"SELECT COUNT(*) FROM (SELECT 1 FROM {cls._table_name} {where_sql} LIMIT %(limit)s) t",
+                filter_params=filter_params)
+        return QueryPlan(sql=f"SELECT COUNT(*) FROM {cls._table_name} {where_sql}", filter_params=filter_params)
 
-        async with conn.cursor(aiomysql.SSDictCursor) as cur:
-            await cur.execute(f"SELECT "
-                              f"{','.join(fields)}"
-                              f" FROM {cls._table_name} "
-                              f" {where_sql} "
-                              f" ORDER BY user_id "
-                              f"LIMIT %(limit)s OFFSET %(offset)s",
-                              query_params)
-            result = await cur.fetchall()
-            return result or []
+    @classmethod
+    async def _iter_ids(cls, conn, by_field, by_value, id_field, chunk_size):
+        last_id = 0
+        while True:
+            rows = await cls.filter(
+                conn=conn,
+                filter={by_field: by_value, id_field: {'op': 'gt', 'v': last_id}},
+                fields=[id_field], limit=chunk_size, order_by=id_field)
+            if not rows:
+                return
+            yield [row[id_field] for row in rows]
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1][id_field]
+
+    @classmethod
+    def iter_subscriber_ids(cls, conn, friend_id, chunk_size=1000):
+        """Yield user_id`s of friend_id subscribers by chunks, seeking by user_id instead of offset
+        on friend_friend_id_user_id_index (migrations/0007_friend_index.sql)."""
+        return cls._iter_ids(conn, 'friend_id', friend_id, 'user_id', chunk_size)
+
+    @classmethod
+    def iter_friend_ids(cls, conn, user_id, chunk_size=1000):
+        """Yield friend_id`s followed by user_id by chunks, seeking by friend_id instead of offset."""
+        return cls._iter_ids(conn, 'user_id', user_id, 'friend_id', chunk_size)
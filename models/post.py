@@ -1,8 +1,18 @@
+import datetime
+import functools
+import heapq
+import itertools
+from typing import Tuple
+
 import aiomysql
 
+from .base import decode_cursor
+from .base import encode_cursor
 from .base import FILTER_OP
 from .base import make_param_name
 from .base import Model
+from .base import QueryPlan
+from .base import split_filter
 
 
 class Post(Model):
@@ -66,50 +76,120 @@ class Post(Model):
                 await conn.commit()
         return self.id
 
+    @staticmethod
+    def make_cursor(post: dict) -> str:
+        """Cursor pointing to posts older than `post` in (created_at, id) order."""
+        return encode_cursor([post['created_at'].isoformat(), post['id']])
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> tuple:
+        """Inverse of make_cursor.
+        :raise ValueError: if cursor is malformed
+        """
+        created_at, post_id = decode_cursor(cursor, 2)
+        if not isinstance(created_at, str) or not isinstance(post_id, int):
+            raise ValueError(f'bad cursor: {cursor!r}')
+        return datetime.datetime.fromisoformat(created_at), post_id
+
+    @classmethod
+    async def filter(cls, conn, filter: dict = None, limit=20, offset=0, fields: list = None,
+                     before: tuple = None):
+        """Posts from newest to oldest.
+        :param before: (created_at, id) of the last post of previous page (see parse_cursor),
+            seeks on post_author_id_created_at_id_index instead of skipping `offset` rows
+        """
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+
+            await cur.execute(*cls.filter_query(filter, limit, offset, fields, before))
+            result = await cur.fetchall()
+            return result or []
+
+    @classmethod
+    def filter_query(cls, filter: dict = None, limit=20, offset=0, fields: list = None,
+                     before: tuple = None) -> Tuple[str, dict]:
+        """SQL and parameters of filter(), for models.base.Batch."""
+        filter_shape, filter_values = split_filter(filter)
+        plan = cls._compile_filter(tuple(fields or cls._default_fields), filter_shape, bool(before))
+
+        query_params = plan.bind(filter_values, limit=int(limit), offset=int(offset))
+        if before:
+            query_params.update(before_created_at=before[0], before_id=before[1], offset=0)
+        return plan.sql, query_params
+
     @classmethod
-    async def filter(cls, conn, filter: dict = None, limit=20, offset=0, fields: list = None):
+    async def filter_of_authors(cls, conn, author_ids: list, limit=20, fields: list = None, before: tuple = None,
+                                chunk_size=100):
+        """Posts of authors from newest to oldest.
+        Every author is a separate seek on post_author_id_created_at_id_index stopping after `limit` rows,
+        seeks are sent as UNION ALL by chunks of authors and merged, instead of sorting all posts of friends.
+        :param fields: chunks are merged by created_at and id, they have to be among them
+        :param before: (created_at, id) of the last post of previous page (see parse_cursor)
+        """
+        fields = tuple(fields or cls._default_fields)
+        feeds = []
+        for start in range(0, len(author_ids), chunk_size):
+            chunk = author_ids[start:start + chunk_size]
+            plan = cls._compile_of_authors(fields, len(chunk), bool(before))
+            query_params = dict(zip(plan.filter_params, chunk), limit=int(limit), offset=0)
+            if before:
+                query_params.update(before_created_at=before[0], before_id=before[1])
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(plan.sql, query_params)
+                feeds.append(await cur.fetchall() or [])
+        posts = heapq.merge(*feeds, key=lambda post: (post['created_at'], post['id']), reverse=True)
+        return list(itertools.islice(posts, int(limit)))
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_of_authors(cls, fields: tuple, authors: int, with_before: bool = False):
+        branch = cls._compile_filter(fields, (('author_id', 'eq'),), with_before)
+        (param,) = branch.filter_params
+        filter_params = tuple(f'{param}_{i}' for i in range(authors))
+        branches = ' UNION ALL '.join(
+            f"({branch.sql.replace(f'%({param})s', f'%({name})s')})" for name in filter_params)
+        return QueryPlan(
+            sql=f"SELECT * FROM ({branches}) posts ORDER BY created_at DESC, id DESC LIMIT %(limit)s",
+            filter_params=filter_params)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_filter(cls, fields: tuple, filter_shape: tuple, with_before: bool = False):
         where_sql = ''
         where = []
 
         join_sql = ''
         joins = []
 
-        if not fields:
-            fields = cls._default_fields
-        else:
-            for field in fields.copy():
-                if field == 'author__name':
-                    from .user import User
-                    joins.append(f' JOIN {User._table_name} author ON author.id = {cls._table_name}.author_id ')
-                    fields.remove(field)
-                    fields.append(" concat(author.firstname, ' ' , author.lastname) as author__name ")
-                    continue
-                assert hasattr(cls, field), f'unknown field: {field}'
-        fields = [
-            (f"{cls._table_name}.{field}" if field in cls._default_fields else field)
-            for field in fields
-        ]
-
-        query_params = dict(limit=int(limit), offset=int(offset))
-
-        if filter:
-            for field, value in filter.items():
-                if field == 'post_of_friends':
-                    # join`им friend чтобы найти посты друзей current_user_id
-                    joins.append(' JOIN friend f ON author_id = f.friend_id ')
-                    field = 'f.user_id'
-                else:
-                    assert hasattr(cls, field), f'unknown field: {field} in filter'
-                op = '='
-                if isinstance(value, dict):
-                    op = FILTER_OP[value['op']]
-                    value = value['v']
-
-                filter_name = make_param_name(query_params, f"{field}_filter")
-                field = (f"{cls._table_name}.{field}" if field in cls._default_fields else field)
-                where.append(f"{field} {op} %({filter_name})s")
-                query_params[filter_name] = value
+        columns = []
+        for field in fields:
+            if field == 'author__name':
+                from .user import User
+                joins.append(f' JOIN {User._table_name} author ON author.id = {cls._table_name}.author_id ')
+                columns.append(" concat(author.firstname, ' ' , author.lastname) as author__name ")
+                continue
+            assert hasattr(cls, field), f'unknown field: {field}'
+            columns.append(f"{cls._table_name}.{field}")
+
+        param_names = {'limit', 'offset', 'before_created_at', 'before_id'}
+        filter_params = []
+        for field, op in filter_shape:
+            if field == 'post_of_friends':
+                # join`им friend чтобы найти посты друзей current_user_id
+                joins.append(' JOIN friend f ON author_id = f.friend_id ')
+                field = 'f.user_id'
+            else:
+                assert hasattr(cls, field), f'unknown field: {field} in filter'
+
+            filter_name = make_param_name(param_names, f"{field}_filter")
+            param_names.add(filter_name)
+            filter_params.append(filter_name)
+            field = (f"{cls._table_name}.{field}" if field in cls._default_fields else field)
+            where.append(f"{field} {FILTER_OP[op]} %({filter_name})s")
+
+        if with_before:
+            where.append(f'{cls._table_name}.created_at <= %(before_created_at)s '
+                         f'AND ({cls._table_name}.created_at < %(before_created_at)s '
+                         f'OR {cls._table_name}.id < %(before_id)s)')
 
         if joins:
             join_sql = ''.join(joins)
@@ -117,15 +197,12 @@ class Post(Model):
         if where:
             where_sql = f"WHERE {' AND '.join(where)}"
 
-        async with conn.cursor(aiomysql.SSDictCursor) as cur:
-
-            await cur.execute(f"SELECT "
-                              f"{','.join(fields)}"
-                              f" FROM {cls._table_name} "
-                              f" {join_sql} "
-                              f" {where_sql} "
-                              f" ORDER BY created_at DESC "
-                              f" LIMIT %(limit)s OFFSET %(offset)s",
-                              query_params)
-            result = await cur.fetchall()
-            return result or []
+        return QueryPlan(
+            sql=(f"SELECT "
+                 f"{','.join(columns)}"
+                 f" FROM {cls._table_name} "
+                 f" {join_sql} "
+                 f" {where_sql} "
+                 f" ORDER BY {cls._table_name}.created_at DESC, {cls._table_name}.id DESC "
+                 f" LIMIT %(limit)s OFFSET %(offset)s"),
+            filter_params=tuple(filter_params))
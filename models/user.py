@@ -1,8 +1,15 @@
+import functools
+from typing import Tuple
+
 import aiomysql
 
-from .base import FILTER_OP
-from .base import make_param_name
+from .base import compile_where
+from .base import decode_cursor
+from .base import encode_cursor
 from .base import Model
+from .base import QueryPlan
+from .base import split_filter
+from .cache import LRUCache
 
 
 class User(Model):
@@ -17,6 +24,18 @@ class User(Model):
     city = None
     interest = None
 
+    # rows by id, see get_by_id; invalidated by `user_changed` event (events.py)
+    cache = LRUCache()
+    # first pages of friends and subscribers by (kind, id), see userpage.load_profile;
+    # invalidated by `friend_changed` event
+    relations_cache = LRUCache()
+
+    # friend_graph.FriendGraph answering is_friend/is_subscriber instead of db, when enabled
+    friend_graph = None
+
+    # field name -> number in tarantool user space, see tnt_field_numbers
+    _tnt_field_numbers = None
+
     # TODO: metaclass
     _default_fields = [
         'id', 'username',
@@ -63,8 +82,21 @@ class User(Model):
         )
 
     @classmethod
-    def get_by_id(cls, uid, conn, fields: list = None):
-        return super(User, cls).get_by_id(uid, conn, fields)
+    async def get_by_id(cls, uid, conn, fields: list = None):
+        if not fields:
+            fields = cls._default_fields
+        if not set(fields).issubset(cls._default_fields) or not str(uid).isdigit():
+            return await super(User, cls).get_by_id(uid, conn, fields)
+
+        # whole row is cached, so any subset of _default_fields is served from it
+        row = cls.cache.get(int(uid))
+        if row is None:
+            user = await super(User, cls).get_by_id(uid, conn, cls._default_fields)
+            if not user:
+                return None
+            row = {field: getattr(user, field) for field in cls._default_fields}
+            cls.cache.set(int(uid), row)
+        return cls.from_dict({'id': row['id'], **{field: row[field] for field in fields}})
 
     async def save(self, conn):
         async with conn.cursor() as cur:
@@ -86,7 +118,7 @@ class User(Model):
                 self.id = uid
                 await conn.commit()
             else:
-                # TODO: update
+                # TODO: update; callers must publish user_changed, User.cache and search index rely on it
                 raise NotImplementedError()
         return self.id
 
@@ -124,59 +156,157 @@ class User(Model):
                 return None
             return cls.from_dict(result)
 
+    @staticmethod
+    def make_cursor(row: dict) -> str:
+        """Cursor pointing after `row` in (lastname, firstname, id) order."""
+        return encode_cursor([row['lastname'], row['firstname'], row['id']])
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> tuple:
+        """Inverse of make_cursor.
+        :raise ValueError: if cursor is malformed
+        """
+        lastname, firstname, uid = decode_cursor(cursor, 3)
+        if not (lastname is None or isinstance(lastname, str)) \
+                or not isinstance(firstname, str) or not isinstance(uid, int):
+            raise ValueError(f'bad cursor: {cursor!r}')
+        return lastname, firstname, uid
+
     @classmethod
     async def filter(cls, conn, current_user_id: int = None,
-                     filter: dict = None, limit=20, offset=0, fields: list = None):
-        if not fields:
-            fields = cls._default_fields
-        else:
-            for field in fields:
-                assert hasattr(cls, field), f'unknown field: {field}'
+                     filter: dict = None, limit=20, offset=0, fields: list = None,
+                     after: tuple = None):
+        """Users ordered by (lastname, firstname, id).
+        :param after: (lastname, firstname, id) of the last row of previous page (see parse_cursor),
+            seeks on user_lastname_firstname_id_index instead of skipping `offset` rows
+        """
+        graph = cls.get_friend_graph()
+        async with conn.cursor(aiomysql.SSDictCursor) as cur:
+            await cur.execute(*cls.filter_query(current_user_id, filter, limit, offset, fields, after,
+                                                with_flags=graph is None))
+            result = await cur.fetchall()
+            if not result:
+                return None
 
-        query_params = dict(limit=int(limit), offset=int(offset))
+            if graph is not None and current_user_id is not None:
+                cls.set_relation_flags(graph, result, current_user_id)
+            return result
+
+    @classmethod
+    def filter_query(cls, current_user_id: int = None, filter: dict = None, limit=20, offset=0, fields: list = None,
+                     after: tuple = None, with_flags=True) -> Tuple[str, dict]:
+        """SQL and parameters of filter(), for models.base.Batch.
+        :param with_flags: select is_subscriber/is_friend flags of current_user_id rows, else set_relation_flags
+        """
+        filter_shape, filter_values = split_filter(filter)
+        after_mode = None
+        if after:
+            after_mode = 'null' if after[0] is None else 'value'
+        plan = cls._compile_filter(
+            tuple(fields or cls._default_fields), filter_shape, current_user_id is not None, after_mode,
+            with_flags=with_flags)
+
+        query_params = plan.bind(filter_values, limit=int(limit), offset=int(offset),
+                                 current_user_id=current_user_id)
+        if after:
+            query_params.update(after_lastname=after[0], after_firstname=after[1], after_id=after[2], offset=0)
+        return plan.sql, query_params
+
+    @classmethod
+    def get_friend_graph(cls):
+        if cls.friend_graph is not None and cls.friend_graph.ready:
+            return cls.friend_graph
+        return None
+
+    @staticmethod
+    def set_relation_flags(graph, rows: list, current_user_id):
+        current_user_id = int(current_user_id)
+        for row in rows:
+            row['is_subscriber'] = graph.is_subscriber(row['id'], current_user_id)
+            row['is_friend'] = graph.is_friend(row['id'], current_user_id)
 
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_filter(cls, fields: tuple, filter_shape: tuple, with_relations: bool, after_mode: str = None,
+                        with_flags: bool = True):
+        for field in fields:
+            assert hasattr(cls, field), f'unknown field: {field}'
+
+        param_names = {'limit', 'offset', 'current_user_id', 'after_lastname', 'after_firstname', 'after_id'}
         is_friend_subquery = ''
         where_sql = ''
         where = []
-        if current_user_id is not None:
+        if with_relations and with_flags:
             is_friend_subquery = (
                 ', EXISTS(SELECT 1 FROM friend f '
                 'WHERE user.id = f.user_id AND f.friend_id = %(current_user_id)s ) is_subscriber '
                 ', EXISTS(SELECT 1 FROM friend f '
                 'WHERE user.id = f.friend_id AND f.user_id = %(current_user_id)s ) is_friend '
             )
+        if with_relations:
             where.append('id != %(current_user_id)s')
-            query_params['current_user_id'] = current_user_id
 
-        if filter:
-            for field, value in filter.items():
-                assert hasattr(cls, field), f'unknown field: {field} in filter'
-                op = '='
-                if isinstance(value, dict):
-                    op = FILTER_OP[value['op']]
-                    value = value['v']
+        filter_where, filter_params = compile_where(cls, filter_shape, param_names)
+        where.extend(filter_where)
 
-                filter_name = make_param_name(query_params, f"{field}_filter")
-                where.append(f"{field} {op} %({filter_name})s")
-                query_params[filter_name] = value
+        if after_mode:
+            tail = ('firstname > %(after_firstname)s '
+                    'OR (firstname = %(after_firstname)s AND id > %(after_id)s)')
+            if after_mode == 'null':
+                # NULL lastnames go first in ORDER BY
+                where.append(f'(lastname IS NOT NULL OR {tail})')
+            else:
+                where.append(f'lastname >= %(after_lastname)s AND (lastname > %(after_lastname)s OR {tail})')
 
         if where:
             where_sql = f"WHERE {' AND '.join(where)}"
 
-        async with conn.cursor(aiomysql.SSDictCursor) as cur:
-            await cur.execute(f"SELECT "
-                              f"{','.join(fields)}"
-                              f"{is_friend_subquery}"
-                              f" FROM {cls._table_name} "
-                              f" {where_sql} "
-                              f" ORDER BY lastname, firstname, id "
-                              f"LIMIT %(limit)s OFFSET %(offset)s",
-                              query_params)
-            result = await cur.fetchall()
-            if not result:
-                return None
+        return QueryPlan(
+            sql=(f"SELECT "
+                 f"{','.join(fields)}"
+                 f"{is_friend_subquery}"
+                 f" FROM {cls._table_name} "
+                 f" {where_sql} "
+                 f" ORDER BY lastname, firstname, id "
+                 f"LIMIT %(limit)s OFFSET %(offset)s"),
+            filter_params=filter_params)
 
-            return result
+    @classmethod
+    async def tnt_field_numbers(cls, tnt) -> dict:
+        """Field numbers of tarantool user space by name, read once from its format."""
+        if cls._tnt_field_numbers is None:
+            res = await tnt.eval('return box.space.user:format()')
+            cls._tnt_field_numbers = {field['name']: no for no, field in enumerate(res[0], 1)}
+        return cls._tnt_field_numbers
+
+    @classmethod
+    async def search_tarantool(cls, tnt, prefix: str, current_user_id: int, limit=20,
+                               after: tuple = None, fields: list = None):
+        """Users with firstname and lastname starting with prefix, ordered by (lastname, firstname, id).
+        :param after: (lastname, firstname, id) of the last row of previous page (see parse_cursor),
+            seeks on lastname_firstname_id index instead of skipping rows
+        """
+        fields = list(fields or cls._default_fields)
+        assert 'id' in fields, 'id is required for relation flags'
+        field_numbers = await cls.tnt_field_numbers(tnt)
+        for field in fields:
+            assert field in field_numbers, f'unknown field: {field}'
+
+        if after:
+            after = [after[0] or '', after[1], after[2]]
+        graph = cls.get_friend_graph()
+        res = await tnt.call(
+            'search_users',
+            [prefix, current_user_id, limit, after, [field_numbers[field] for field in fields], graph is None])
+        if not res or not res[0]:
+            return None
+
+        n = len(fields)
+        if graph is not None:
+            rows = [dict(zip(fields, row)) for row in res[0]]
+            cls.set_relation_flags(graph, rows, current_user_id)
+            return rows
+        return [dict(zip(fields, row[:n]), is_subscriber=row[n], is_friend=row[n + 1]) for row in res[0]]
 
     async def add_friend(self, friend_id, conn):
         async with conn.cursor() as cur:
@@ -194,26 +324,59 @@ class User(Model):
             deleted_rows = cur.rowcount
             return deleted_rows
 
-    async def get_friends(self, conn, fields=None, offset=0, limit=20):
+    @classmethod
+    def invalidate_relations(cls, *uids):
+        for uid in uids:
+            cls.relations_cache.invalidate(('friends', int(uid)))
+            cls.relations_cache.invalidate(('subscribers', int(uid)))
+
+    @classmethod
+    def relations_query(cls, uid, kind: str, fields=None, offset=0, limit=20, ids: list = None) -> Tuple[str, dict]:
+        """SQL and parameters of get_friends or get_subscribers, for models.base.Batch.
+        :param kind: 'friends' or 'subscribers'
+        :param ids: not empty ids of friends or subscribers from friend graph, rows are picked by primary key
+            in the same (firstname, id) order instead of the join with friend
+        """
         if not fields:
-            fields = self._default_fields
+            fields = cls._default_fields
         else:
             for field in fields:
-                assert hasattr(self, field), f'unknown field: {field}'
+                assert hasattr(cls, field), f'unknown field: {field}'
 
         query_params = dict(limit=int(limit), offset=int(offset))
-        query_params['current_user_id'] = self.id
+        query_params['current_user_id'] = uid
+
+        fields = map(lambda field: f'u.{field}', fields)
+        if ids is not None:
+            query_params['ids'] = ids
+            return (f"SELECT {','.join(fields)} "
+                    f"FROM user u "
+                    f"WHERE u.id IN %(ids)s "
+                    f" AND u.id != %(current_user_id)s "
+                    f" ORDER BY firstname, id "
+                    f"LIMIT %(limit)s OFFSET %(offset)s"), query_params
+        if kind == 'friends':
+            return (f"SELECT {','.join(fields)} "
+                    f"FROM user u "
+                    f"JOIN friend f on u.id = f.friend_id "
+                    f"WHERE f.user_id = %(current_user_id)s "
+                    f" AND u.id != %(current_user_id)s "
+                    f" ORDER BY firstname, id "
+                    f"LIMIT %(limit)s OFFSET %(offset)s"), query_params
+        return (f"SELECT {','.join(fields)} "
+                f"FROM user u "
+                f"JOIN friend s on u.id = s.user_id "
+                f"WHERE s.friend_id = %(current_user_id)s "
+                f" AND u.id != %(current_user_id)s "
+                f" AND NOT EXISTS(SELECT 1 FROM friend f "
+                f"                WHERE u.id = f.friend_id "
+                f"                      AND f.user_id = %(current_user_id)s ) "
+                f" ORDER BY firstname, id "
+                f"LIMIT %(limit)s OFFSET %(offset)s"), query_params
 
+    async def get_friends(self, conn, fields=None, offset=0, limit=20):
         async with conn.cursor(aiomysql.DictCursor) as cur:
-            fields = map(lambda field: f'u.{field}', fields)
-            await cur.execute(f"SELECT {','.join(fields)} "
-                              f"FROM user u "
-                              f"JOIN friend f on u.id = f.friend_id "
-                              f"WHERE f.user_id = %(current_user_id)s "
-                              f" AND u.id != %(current_user_id)s "
-                              f" ORDER BY firstname, id "
-                              f"LIMIT %(limit)s OFFSET %(offset)s",
-                              query_params)
+            await cur.execute(*self.relations_query(self.id, 'friends', fields, offset, limit))
             result = await cur.fetchall()
             if not result:
                 return None
@@ -221,28 +384,8 @@ class User(Model):
             return result
 
     async def get_subscribers(self, conn, fields=None, offset=0, limit=20):
-        if not fields:
-            fields = self._default_fields
-        else:
-            for field in fields:
-                assert hasattr(self, field), f'unknown field: {field}'
-
-        query_params = dict(limit=int(limit), offset=int(offset))
-        query_params['current_user_id'] = self.id
-
         async with conn.cursor(aiomysql.DictCursor) as cur:
-            fields = map(lambda field: f'u.{field}', fields)
-            await cur.execute(f"SELECT {','.join(fields)} "
-                              f"FROM user u "
-                              f"JOIN friend s on u.id = s.user_id "
-                              f"WHERE s.friend_id = %(current_user_id)s "
-                              f" AND u.id != %(current_user_id)s "
-                              f" AND NOT EXISTS(SELECT 1 FROM friend f "
-                              f"                WHERE u.id = f.friend_id "
-                              f"                      AND f.user_id = %(current_user_id)s ) "
-                              f" ORDER BY firstname, id "
-                              f"LIMIT %(limit)s OFFSET %(offset)s",
-                              query_params)
+            await cur.execute(*self.relations_query(self.id, 'subscribers', fields, offset, limit))
             result = await cur.fetchall()
             if not result:
                 return None
@@ -10,33 +10,86 @@ import aiohttp_session
 import aiomysql
 import arq
 
+import codec
+from db_router import acquire_ro
+from db_router import record_write
+from feed import enqueue_rebuild
+from feed import NEWS_FIELDS
+from feed import post_sort_key
+from feed import read_feed
+from feed import wait_for_rebuild
 from login import require_login
+from metrics import timed
+from models.friend import Friend
 from models.post import Post
+from presence import PresenceRegistry
 
 logger = logging.getLogger('news')
 
 
-@require_login
-@aiohttp_jinja2.template('newspage.jinja2')
-async def hanlde_newspage(request: web.Request):
-    session = await aiohttp_session.get_session(request)
-    uid = session["uid"]
+NEWS_PAGE_SIZE = 20
+
+
+def parse_before(request: web.Request):
+    if not request.rel_url.query.get('before'):
+        return None
+    try:
+        return Post.parse_cursor(request.rel_url.query['before'])
+    except ValueError:
+        raise web.HTTPBadRequest(reason='bad cursor')
 
+
+async def load_news_page(request: web.Request, uid, before: tuple = None, limit=NEWS_PAGE_SIZE):
+    """Page of news older than `before`, newest first.
+    Pages are served from redis cache, db is read only when the cursor runs
+    past the end of the cached feed, continuing from the last cached post.
+    :return: posts, cursor of the next page or None
+    """
     posts = []
+    complete = False
     redis = request.app.get("arq_pool")
     if redis:
-        key = f'news:{uid}'
-        posts_jsons = await redis.lrange(key, 0, -1)
-        posts = list(map(json.loads, posts_jsons))
+        async def load_posts(post_ids):
+            async with acquire_ro(request) as conn:
+                return await Post.filter(
+                    conn=conn, filter=dict(id={'op': 'in', 'v': post_ids}), limit=len(post_ids),
+                    fields=NEWS_FIELDS)
+
+        with timed('redis', 'read_feed'):
+            feed = await read_feed(redis, uid, limit=limit + 1, before=before, load_posts=load_posts)
+        if not feed.cached and before is None:
+            # cold cache: let a single rebuild query db instead of every concurrent reader,
+            # the rebuilt feed is whole or longer than a page, db is not read after it
+            if await wait_for_rebuild(redis, uid):
+                with timed('redis', 'read_feed'):
+                    feed = await read_feed(redis, uid, limit=limit + 1, load_posts=load_posts)
+            else:
+                await enqueue_rebuild(redis, uid)
+        posts, complete = feed.posts, feed.complete
         logging.debug('posts from cache: %r', posts)
-    if not posts:
-        pool: aiomysql.pool.Pool = request.app['db_ro_pool']
-        async with pool.acquire() as conn:
-            posts = await Post.filter(
-                conn=conn, filter=dict(post_of_friends=uid),
-                fields=['author__name', 'id', 'author_id', 'text', 'created_at', 'updated_at'])
 
-    return dict(posts=posts, session=session)
+    if len(posts) <= limit and not complete:
+        async with acquire_ro(request) as conn:
+            friend_ids = [friend_id async for chunk in Friend.iter_friend_ids(conn, user_id=uid)
+                          for friend_id in chunk]
+            posts.extend(await Post.filter_of_authors(
+                conn=conn, author_ids=friend_ids,
+                before=post_sort_key(posts[-1]) if posts else before,
+                limit=limit + 1 - len(posts), fields=NEWS_FIELDS))
+
+    next_cursor = None
+    if len(posts) > limit:
+        next_cursor = Post.make_cursor(posts[limit - 1])
+    return posts[:limit], next_cursor
+
+
+@require_login
+@aiohttp_jinja2.template('newspage.jinja2')
+async def hanlde_newspage(request: web.Request):
+    session = await aiohttp_session.get_session(request)
+    before = parse_before(request)
+    posts, next_cursor = await load_news_page(request, session["uid"], before=before)
+    return dict(posts=posts, session=session, before=before, next_cursor=next_cursor)
 
 
 @require_login
@@ -47,8 +100,14 @@ async def hanlde_add_post(request: web.Request):
     async with pool.acquire() as conn:
         post_id = await Post(author_id=session['uid'], text=form["text"]).save(conn)
         await conn.commit()
-        arq_pool: arq.ArqRedis = request.app['arq_pool']
-        await arq_pool.enqueue_job('add_post_to_cache', post_id)
+        await record_write(request, conn)
+        arq_pool: arq.ArqRedis = request.app.get('arq_pool')
+        if arq_pool:
+            # carry the post in the job, so the worker does not read it from primary again
+            post = (await Post.filter(
+                filter={'id': post_id}, conn=conn,
+                fields=NEWS_FIELDS))[0]
+            await arq_pool.enqueue_job('add_post_to_cache', post_id, post=post)
     location = request.headers.get('Referer', '/userpage/')
     return web.HTTPFound(location=location)
 
@@ -63,9 +122,10 @@ async def handle_news_ws(request: web.Request):
     logger.debug('Websocket connection ready uid: %r', uid)
     app = request.app
     sid = request.headers['Sec-WebSocket-Key']  # TODO: generate uniq session
-    app['news_subscribers'][uid][sid] = ws
-
-    await set_subscriber(uid, sid, app)
+    app['news_broadcaster'].register(uid, sid, ws)
+    presence: PresenceRegistry = app.get('presence')
+    if presence:
+        presence.connect(uid)
     try:
         msg: aiohttp.WSMessage
         async for msg in ws:
@@ -76,46 +136,17 @@ async def handle_news_ws(request: web.Request):
                 else:
                     # await ws.send_str()
                     jmsg = json.loads(msg.data)
-                    await ws.send_json({'request': jmsg, 'sid': sid})
-                    if jmsg.get('type') == 'ping':
-                        await set_subscriber(uid, sid, app)
+                    await ws.send_json({'request': jmsg, 'sid': sid}, dumps=codec.dumps_json)
 
     finally:
-        await delete_subscriber(uid, sid, app)
+        app['news_broadcaster'].unregister(uid, sid)
+        if presence:
+            presence.disconnect(uid)
 
     logger.debug('Websocket connection closed uid: %r', uid)
     return ws
 
 
-def get_subscriber_instances_key(uid, sid, topic='news'):
-    return f'{topic}:{uid}:instances'
-
-
-async def set_subscriber(uid, sid, app, ttl=5):
-    redis: arq.ArqRedis = app.get('arq_pool')
-    subscriber_key = get_subscriber_instances_key(uid, sid)
-    if redis:
-        await redis.sadd(subscriber_key, app['instance_id'])
-        await redis.expire(subscriber_key, ttl)
-
-
-async def delete_subscriber(uid, sid, app):
-    redis: arq.ArqRedis = app.get('arq_pool')
-    subscriber_key = get_subscriber_instances_key(uid, sid)
-
-    sessions_dict = app['news_subscribers'].get(uid)
-    if sessions_dict:
-        sessions_dict.pop(sid, None)
-    if not sessions_dict:
-        app['news_subscribers'].pop(uid, None)
-
-    if redis:
-        try:
-            await redis.srem(subscriber_key, app['instance_id'])
-        except Exception as ex:
-            logger.exception('redis.srem %r', ex)
-
-
 async def listen_news_updates(app):
     rabbit: aio_pika.Connection = app.get('rabbit')
     if not rabbit:
@@ -138,21 +169,18 @@ async def listen_news_updates(app):
                 async for message in queue_iter:
                     async with message.process():
                         logger.debug('listen_news_updates: message: %r', message.body)
-                        if message.content_type != 'application/json':
-                            continue
-                        post = json.loads(message.body)
-                        if not post:
+                        body = codec.decode_message(message.content_type, message.body)
+                        if not body:
                             continue
-                        subscriber_id = post.get('subscriber_id')
-                        if not subscriber_id:
-                            continue
-
-                        for sid, ws in app['news_subscribers'].get(subscriber_id, {}).items():
-                            logger.debug('send message to websocket %r %r', ws, sid)
-                            try:
-                                await ws.send_json({'type': 'posts', 'data': [post]})
-                            except ConnectionResetError:
-                                logger.debug('Outdated connection %r', sid)
+                        if 'subscriber_ids' in body:
+                            # one message for all subscribers on this instance (NewsPublisher)
+                            post = body['post']
+                            subscriber_ids = body['subscriber_ids']
+                        else:
+                            post = body
+                            subscriber_ids = [post.get('subscriber_id')]
+
+                        app['news_broadcaster'].broadcast(post, subscriber_ids)
         except asyncio.CancelledError:
             break
         except Exception as ex:
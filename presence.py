@@ -0,0 +1,149 @@
+"""Which server instances hold websockets of which users.
+
+Every instance keeps its online uids in the `presence:{instance_id}` set and
+its last heartbeat in the `presence:instances` zset. Both are written by one
+pipelined heartbeat per interval, or shortly after users connect or leave.
+"""
+import asyncio
+from collections import Counter
+import logging
+import os
+import time
+from typing import Dict, Iterable, List
+
+import arq
+
+from metrics import timed
+
+logger = logging.getLogger('presence')
+
+PRESENCE_INTERVAL = float(os.getenv('PRESENCE_INTERVAL', 5))
+# instance is considered gone when it misses heartbeats that long
+PRESENCE_TTL = int(3 * PRESENCE_INTERVAL)
+# changes arriving meanwhile are written by the same heartbeat
+PRESENCE_BATCH_DELAY = 0.05
+
+INSTANCES_KEY = 'presence:instances'
+
+
+def instance_key(instance_id):
+    return f'presence:{instance_id}'
+
+
+class PresenceRegistry:
+    """Online uids of this instance, tracked locally and flushed to redis in batches."""
+
+    def __init__(self, redis: arq.ArqRedis, instance_id, interval=PRESENCE_INTERVAL):
+        self.redis = redis
+        self.instance_id = instance_id
+        self.interval = interval
+        # uid -> open websockets
+        self._counts = Counter()
+        self._added = set()
+        self._removed = set()
+        # write whole set on next heartbeat, after redis lost it or a heartbeat failed
+        self._resync = True
+        self._changed = asyncio.Event()
+        self._task: asyncio.Task = None
+
+    def connect(self, uid):
+        self._counts[uid] += 1
+        if self._counts[uid] == 1:
+            self._added.add(uid)
+            self._removed.discard(uid)
+            self._changed.set()
+
+    def disconnect(self, uid):
+        self._counts[uid] -= 1
+        if self._counts[uid] <= 0:
+            del self._counts[uid]
+            self._removed.add(uid)
+            self._added.discard(uid)
+            self._changed.set()
+
+    def __contains__(self, uid):
+        return uid in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    async def heartbeat(self):
+        key = instance_key(self.instance_id)
+        added, removed, resync = self._added, self._removed, self._resync
+        self._added, self._removed, self._resync = set(), set(), False
+
+        pipe = self.redis.pipeline()
+        if resync:
+            pipe.delete(key)
+            if self._counts:
+                pipe.sadd(key, *self._counts)
+        else:
+            if removed:
+                pipe.srem(key, *removed)
+            if added:
+                pipe.sadd(key, *added)
+        pipe.expire(key, PRESENCE_TTL)
+        pipe.zadd(INSTANCES_KEY, time.time(), self.instance_id)
+        try:
+            with timed('redis', 'presence_heartbeat'):
+                results = await pipe.execute()
+        except Exception:
+            self._resync = True
+            raise
+
+        key_expired = not results[-2]
+        if key_expired and self._counts:
+            self._resync = True
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), self.interval)
+                await asyncio.sleep(PRESENCE_BATCH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.error('presence heartbeat: %r', ex)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        pipe = self.redis.pipeline()
+        pipe.delete(instance_key(self.instance_id))
+        pipe.zrem(INSTANCES_KEY, self.instance_id)
+        try:
+            await pipe.execute()
+        except Exception as ex:
+            logger.error('presence close: %r', ex)
+
+
+async def lookup_instances(redis: arq.ArqRedis, uids: Iterable[int]) -> Dict[str, List[int]]:
+    """Group online uids by instances holding their websockets, offline ones are left out."""
+    uids = list(uids)
+    if not uids:
+        return {}
+
+    with timed('redis', 'presence_lookup'):
+        instance_ids = await redis.zrangebyscore(INSTANCES_KEY, min=time.time() - PRESENCE_TTL)
+        if not instance_ids:
+            return {}
+        instance_ids = [instance_id.decode() if isinstance(instance_id, bytes) else instance_id
+                        for instance_id in instance_ids]
+        # concurrent commands share a connection pipeline in aioredis
+        flags = await asyncio.gather(*(
+            redis.execute(b'SMISMEMBER', instance_key(instance_id), *uids) for instance_id in instance_ids))
+
+    instances = {}
+    for instance_id, is_member in zip(instance_ids, flags):
+        online = [uid for uid, member in zip(uids, is_member) if member]
+        if online:
+            instances[instance_id] = online
+    return instances
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List
+
+import aio_pika
+import arq
+
+import codec
+from presence import lookup_instances
+
+logger = logging.getLogger('publisher')
+
+
+class NewsPublisher:
+    """Publishes posts to the server instances holding websockets of subscribers.
+
+    One message per instance carries all subscriber_ids it serves,
+    channel and exchange are opened once and reused between posts.
+    """
+
+    def __init__(self, rabbit: aio_pika.Connection, redis: arq.ArqRedis, exchange_name='news'):
+        self._rabbit = rabbit
+        self._redis = redis
+        self._exchange_name = exchange_name
+        self._channel: aio_pika.Channel = None
+        self._exchange: aio_pika.Exchange = None
+        self._lock = asyncio.Lock()
+
+    async def _get_exchange(self) -> aio_pika.Exchange:
+        async with self._lock:
+            if self._channel is None or self._channel.is_closed:
+                self._channel = await self._rabbit.channel()
+                self._exchange = await self._channel.get_exchange(self._exchange_name)
+        return self._exchange
+
+    async def resolve_instances(self, subscriber_ids: Iterable[int]) -> Dict[str, List[int]]:
+        """Group subscriber_ids by instances they are connected to."""
+        return await lookup_instances(self._redis, subscriber_ids)
+
+    async def publish(self, post: dict, subscriber_ids: Iterable[int]) -> int:
+        """Send post to online subscribers.
+        :return: number of published messages
+        """
+        instances = await self.resolve_instances(subscriber_ids)
+        if not instances:
+            return 0
+
+        exchange = await self._get_exchange()
+        for instance_id, instance_subscriber_ids in instances.items():
+            msg = aio_pika.Message(
+                body=codec.packb(dict(post=post, subscriber_ids=instance_subscriber_ids)),
+                content_type=codec.CONTENT_TYPE)
+            await exchange.publish(msg, routing_key=instance_id)
+            logger.debug('publish post %r to %r subscribers with routing_key: %r',
+                         post['id'], len(instance_subscriber_ids), instance_id)
+        return len(instances)
+
+    async def close(self):
+        if self._channel is not None and not self._channel.is_closed:
+            await self._channel.close()
@@ -0,0 +1,172 @@
+"""Friends of friends recommendations ("people you may know").
+
+Worker keeps a snapshot of `friend` edges in CSR numpy arrays. Candidates of a
+user are users followed by its friends and not followed by the user itself,
+ranked by the number of mutual friends. Top RECS_SIZE of them are stored packed
+in `recs:{uid}`, so the user page reads them with a single GET.
+"""
+import datetime
+import logging
+import os
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import aiomysql
+import arq
+import numpy as np
+
+import codec
+
+logger = logging.getLogger('recommendations')
+
+RECS_SIZE = int(os.getenv('RECS_SIZE', 10))
+RECS_TTL = 7 * 24 * 60 * 60
+# snapshot is reloaded from db when older or when that many users got their friends changed
+RECS_SNAPSHOT_MAX_AGE = int(os.getenv('RECS_SNAPSHOT_MAX_AGE', 6 * 60 * 60))
+RECS_OVERLAY_MAX = int(os.getenv('RECS_OVERLAY_MAX', 100000))
+# followers of a changed user recomputed right away, the rest wait for the full run
+RECS_FANOUT_MAX = int(os.getenv('RECS_FANOUT_MAX', 1000))
+# recomputes of one user are coalesced within the window (deterministic arq job id)
+RECS_UPDATE_WINDOW = int(os.getenv('RECS_UPDATE_WINDOW', 5))
+RECS_BATCH_SIZE = 1000
+# hour of the nightly full rebuild
+RECS_BUILD_HOUR = int(os.getenv('RECS_BUILD_HOUR', 4))
+LOAD_CHUNK_SIZE = 100000
+
+
+def recs_key(uid):
+    return f'recs:{uid}'
+
+
+class AdjacencySnapshot:
+    """Out-edges of all users: `targets[offsets[uid]:offsets[uid + 1]]` are friend ids of uid.
+
+    Friend lists changed since load are replaced as a whole in the overlay.
+    """
+
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray):
+        self.offsets = offsets
+        self.targets = targets
+        self.overlay: Dict[int, np.ndarray] = {}
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def from_edges(cls, sources: np.ndarray, targets: np.ndarray, max_id) -> 'AdjacencySnapshot':
+        """:param sources, targets: edge ends in any order"""
+        order = np.lexsort((targets, sources))
+        offsets = np.zeros(max_id + 2, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=max_id + 1), out=offsets[1:])
+        return cls(offsets, targets[order].astype(np.uint32))
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.loaded_at
+
+    @property
+    def nodes(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.targets.nbytes
+
+    def stats(self) -> dict:
+        edges = len(self.targets)
+        return dict(users=self.nodes, edges=edges, overlay=len(self.overlay), bytes=self.nbytes,
+                    bytes_per_edge=round(self.nbytes / edges, 2) if edges else None)
+
+    def friends(self, uid) -> np.ndarray:
+        if uid in self.overlay:
+            return self.overlay[uid]
+        if uid + 1 >= len(self.offsets):
+            return self.targets[0:0]
+        return self.targets[self.offsets[uid]:self.offsets[uid + 1]]
+
+    def users_with_friends(self, start, stop) -> List[int]:
+        """Ids in [start, stop) with friends in snapshot."""
+        stop = min(stop, self.nodes)
+        return (np.flatnonzero(np.diff(self.offsets[start:stop + 1])) + start).tolist()
+
+    def set_friends(self, uid, friend_ids: Iterable[int]):
+        self.overlay[int(uid)] = np.unique(np.fromiter(friend_ids, dtype=np.uint32))
+
+    def candidates(self, uid, limit=RECS_SIZE) -> List[Tuple[int, int]]:
+        """(candidate id, mutual friends) ordered by mutual friends desc, id."""
+        friends = self.friends(uid)
+        if not len(friends):
+            return []
+
+        # friend lists of all friends are gathered with one fancy index
+        known = friends[friends < self.nodes].astype(np.int64)
+        starts = self.offsets[known]
+        lengths = self.offsets[known + 1] - starts
+        changed = [friend_id for friend_id in friends.tolist() if friend_id in self.overlay]
+        if changed:
+            lengths[np.isin(known, changed)] = 0
+        total = int(lengths.sum())
+        shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        reached = self.targets[shifts + np.arange(total, dtype=np.int64)]
+        if changed:
+            reached = np.concatenate([reached] + [self.overlay[friend_id] for friend_id in changed])
+        if not len(reached):
+            return []
+
+        candidate_ids, mutual = np.unique(reached, return_counts=True)
+        keep = ~np.isin(candidate_ids, friends, assume_unique=True) & (candidate_ids != uid)
+        candidate_ids, mutual = candidate_ids[keep], mutual[keep]
+        if len(candidate_ids) > limit:
+            # ties with the last one are kept, so the cut is made by id
+            threshold = np.partition(mutual, len(mutual) - limit)[len(mutual) - limit]
+            top = mutual >= threshold
+            candidate_ids, mutual = candidate_ids[top], mutual[top]
+        order = np.lexsort((candidate_ids, -mutual))[:limit]
+        return list(zip(candidate_ids[order].tolist(), mutual[order].tolist()))
+
+    @classmethod
+    async def load_from_db(cls, pool: aiomysql.pool.Pool) -> 'AdjacencySnapshot':
+        started = time.perf_counter()
+        chunks = []
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute('SELECT COALESCE(MAX(id), 0) FROM user')
+                (max_id,) = await cur.fetchone()
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute('SELECT user_id, friend_id FROM friend')
+                while True:
+                    chunk = await cur.fetchmany(LOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(np.array(chunk, dtype=np.uint32))
+        edges = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype=np.uint32)
+        if len(edges):
+            # users registered after max(id) was read
+            max_id = max(max_id, int(edges.max()))
+        snapshot = cls.from_edges(edges[:, 0].astype(np.int64), edges[:, 1], max_id)
+        logger.info('recommendations snapshot loaded: %r in %.2fs', snapshot.stats(), time.perf_counter() - started)
+        return snapshot
+
+
+def compute_batch(snapshot: AdjacencySnapshot, uids: Iterable[int],
+                  limit=RECS_SIZE) -> Dict[int, List[Tuple[int, int]]]:
+    return {uid: snapshot.candidates(uid, limit) for uid in uids}
+
+
+def store_recommendations(pipe, recs: Dict[int, List[Tuple[int, int]]], ttl=RECS_TTL):
+    for uid, candidates in recs.items():
+        pipe.set(recs_key(uid), codec.packb(candidates), expire=ttl)
+
+
+async def get_recommendations(redis: arq.ArqRedis, uid) -> List[Tuple[int, int]]:
+    """:return: (candidate id, mutual friends), empty until computed"""
+    data = await redis.get(recs_key(uid))
+    if not data:
+        return []
+    return [tuple(candidate) for candidate in codec.unpackb(data)]
+
+
+async def enqueue_recompute(redis: arq.ArqRedis, uid):
+    """Enqueue update_recommendations for uid after the window closes, once per window."""
+    bucket = int(time.time() // RECS_UPDATE_WINDOW)
+    return await redis.enqueue_job(
+        'update_recommendations', user_id=uid, _job_id=f'update_recommendations:{uid}:{bucket}',
+        _defer_until=datetime.datetime.fromtimestamp((bucket + 1) * RECS_UPDATE_WINDOW, datetime.timezone.utc))
@@ -29,7 +29,7 @@ CREATE TABLE IF NOT EXISTS `friend` (
   `friend_id` bigint(20) NOT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `unique_user_id_friend_id` (`user_id`,`friend_id`),
-  KEY `friend_id` (`friend_id`),
+  KEY `friend_friend_id_user_id_index` (`friend_id`,`user_id`),
   CONSTRAINT `friend_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE,
   CONSTRAINT `friend_ibfk_2` FOREIGN KEY (`friend_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
@@ -46,6 +46,8 @@ CREATE TABLE IF NOT EXISTS `post` (
   FOREIGN KEY (`author_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
 ) ENGINE='InnoDB'  DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 
+CREATE INDEX /*IF NOT EXISTS*/ `post_author_id_created_at_id_index` ON `post`(`author_id`, `created_at`, `id`);
+
 
 SET NAMES utf8;
 SET time_zone = '+00:00';
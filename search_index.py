@@ -0,0 +1,224 @@
+"""In-process prefix index over user names.
+
+Distinct case folded names are interned in one sorted table, so a name code
+orders as the name does. Every user is a `lastname code << 32 | firstname code`
+key next to its id in numpy arrays sorted by (key, id). `firstname LIKE 'x%'
+AND lastname LIKE 'x%'` turns into one bisect of the firstname range per
+distinct lastname starting with the prefix, users themselves are not scanned.
+Rows are read by id from db, the index only holds what orders them.
+"""
+import asyncio
+import bisect
+import logging
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+import aiomysql
+import numpy as np
+
+from db_router import acquire_ro
+from events import subscribe
+from metrics import timed
+from models.user import User
+
+logger = logging.getLogger('search_index')
+
+USER_SEARCH_INDEX = os.getenv('USER_SEARCH_INDEX', '') in ('1', 'true', 'yes')
+LOAD_CHUNK_SIZE = 10000
+
+# sorts after any character, upper bound of a prefix range
+_MAX_CHAR = '\U0010ffff'
+_CODE_BITS = 32
+_CODE_MASK = (1 << _CODE_BITS) - 1
+
+
+def _fold(name: Optional[str]) -> str:
+    return (name or '').casefold()
+
+
+class UserSearchIndex:
+
+    def __init__(self):
+        # distinct folded names, code of a name is its position
+        self._names: List[str] = []
+        self._names_bytes = sys.getsizeof(self._names)
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._ids = np.zeros(0, dtype=np.int64)
+        # changes received while loading, applied on top of loaded rows
+        self._pending = []
+        self.ready = False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _code(self, name: str) -> Tuple[int, bool]:
+        """:return: code of name or of the first name after it, True if name is in the table"""
+        code = bisect.bisect_left(self._names, name)
+        return code, code < len(self._names) and self._names[code] == name
+
+    def _intern(self, name: str):
+        code, found = self._code(name)
+        if not found:
+            self._names.insert(code, name)
+            self._names_bytes += sys.getsizeof(name) + 8
+            # codes after the new name move by one, order of keys is kept
+            lastnames, firstnames = self._keys >> _CODE_BITS, self._keys & _CODE_MASK
+            lastnames += lastnames >= code
+            firstnames += firstnames >= code
+            self._keys = lastnames << _CODE_BITS | firstnames
+
+    def _find(self, key: int, uid: int) -> int:
+        """Position of (key, uid) in sorted arrays."""
+        lo = int(np.searchsorted(self._keys, key, 'left'))
+        hi = int(np.searchsorted(self._keys, key, 'right'))
+        return lo + int(np.searchsorted(self._ids[lo:hi], uid, 'left'))
+
+    def _position_after(self, lastname: str, firstname: str, uid: int) -> int:
+        """Position of the first user after (lastname, firstname, uid) in index order."""
+        lastname_code, found = self._code(lastname)
+        if not found:
+            return int(np.searchsorted(self._keys, lastname_code << _CODE_BITS, 'left'))
+        firstname_code, found = self._code(firstname)
+        key = lastname_code << _CODE_BITS | firstname_code
+        if not found:
+            return int(np.searchsorted(self._keys, key, 'left'))
+        lo = int(np.searchsorted(self._keys, key, 'left'))
+        hi = int(np.searchsorted(self._keys, key, 'right'))
+        return lo + int(np.searchsorted(self._ids[lo:hi], uid, 'right'))
+
+    def load(self, rows: List[Tuple[int, Optional[str], Optional[str]]]):
+        """Replace contents with (id, lastname, firstname) rows."""
+        folded = [(uid, _fold(lastname), _fold(firstname)) for uid, lastname, firstname in rows]
+        names = sorted({name for _, lastname, firstname in folded for name in (lastname, firstname)})
+        codes = {name: code for code, name in enumerate(names)}
+        keys = np.fromiter((codes[lastname] << _CODE_BITS | codes[firstname] for _, lastname, firstname in folded),
+                           dtype=np.int64, count=len(folded))
+        ids = np.fromiter((uid for uid, _, _ in folded), dtype=np.int64, count=len(folded))
+        order = np.lexsort((ids, keys))
+        self._names = names
+        self._names_bytes = sys.getsizeof(names) + sum(map(sys.getsizeof, names))
+        self._keys, self._ids = keys[order], ids[order]
+
+    def add(self, uid: int, lastname: Optional[str], firstname: Optional[str]):
+        if not self.ready:
+            self._pending.append((uid, lastname, firstname))
+            return
+        lastname, firstname = _fold(lastname), _fold(firstname)
+        # interning one name may move the code of the other
+        self._intern(lastname)
+        self._intern(firstname)
+        key, uid = self._code(lastname)[0] << _CODE_BITS | self._code(firstname)[0], int(uid)
+        i = self._find(key, uid)
+        if i < len(self._ids) and self._keys[i] == key and self._ids[i] == uid:
+            # event delivered twice
+            return
+        self._keys = np.insert(self._keys, i, key)
+        self._ids = np.insert(self._ids, i, uid)
+
+    def remove(self, uid: int, lastname: Optional[str], firstname: Optional[str]):
+        # names stay interned, they are likely shared with other users
+        lastname_code, found_lastname = self._code(_fold(lastname))
+        firstname_code, found_firstname = self._code(_fold(firstname))
+        if not (found_lastname and found_firstname):
+            return
+        key, uid = lastname_code << _CODE_BITS | firstname_code, int(uid)
+        i = self._find(key, uid)
+        if i < len(self._ids) and self._keys[i] == key and self._ids[i] == uid:
+            self._keys = np.delete(self._keys, i)
+            self._ids = np.delete(self._ids, i)
+
+    def search(self, prefix: str, limit=20, after: tuple = None, exclude: int = None) -> List[int]:
+        """Ids of users with lastname and firstname starting with prefix, in index order.
+        :param after: (lastname, firstname, id) of the last user of previous page
+        """
+        prefix = _fold(prefix)
+        # codes of names starting with prefix, for lastnames and firstnames alike
+        lo = bisect.bisect_left(self._names, prefix)
+        hi = bisect.bisect_left(self._names, prefix + _MAX_CHAR, lo)
+        if lo == hi:
+            return []
+        start = int(np.searchsorted(self._keys, lo << _CODE_BITS, 'left'))
+        stop = int(np.searchsorted(self._keys, hi << _CODE_BITS, 'left'))
+        if after:
+            start = max(start, self._position_after(_fold(after[0]), _fold(after[1]), after[2]))
+
+        ids = []
+        while start < stop and len(ids) < limit:
+            # users of one lastname are sorted by firstname, matching ones are a single range
+            lastname_code = int(self._keys[start]) >> _CODE_BITS
+            first = max(start, int(np.searchsorted(self._keys, lastname_code << _CODE_BITS | lo, 'left')))
+            last = int(np.searchsorted(self._keys, lastname_code << _CODE_BITS | hi, 'left'))
+            matched = self._ids[first:min(last, first + limit + 1 - len(ids))].tolist()
+            ids.extend(uid for uid in matched if uid != exclude)
+            start = int(np.searchsorted(self._keys, (lastname_code + 1) << _CODE_BITS, 'left'))
+        return ids[:limit]
+
+    def stats(self) -> dict:
+        """Memory footprint of arrays and of the name table, every distinct name is counted once."""
+        return dict(items=len(self), names=len(self._names),
+                    bytes=self._keys.nbytes + self._ids.nbytes + self._names_bytes)
+
+    async def load_from_db(self, pool: aiomysql.pool.Pool):
+        started = time.perf_counter()
+        rows = []
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(f'SELECT id, lastname, firstname FROM {User._table_name}')
+                while True:
+                    chunk = await cur.fetchmany(LOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    rows.extend(chunk)
+        # sorting millions of names takes seconds, keep the loop serving meanwhile;
+        # nothing reads the index before it is ready and changes wait in _pending
+        await asyncio.get_event_loop().run_in_executor(None, self.load, rows)
+        self.ready = True
+        for uid, lastname, firstname in self._pending:
+            self.add(uid, lastname, firstname)
+        self._pending = []
+        logger.info('user search index loaded: %r in %.2fs', self.stats(), time.perf_counter() - started)
+
+
+async def handle_user_changed(app: web.Application, event: dict):
+    if 'lastname' in event or 'firstname' in event:
+        app['search_index'].add(event['id'], event.get('lastname'), event.get('firstname'))
+
+
+async def search_users(request: web.Request, prefix: str, current_user_id: int, limit=20,
+                       after: tuple = None, fields: list = None):
+    """User rows matching prefix, ordered as the index orders them."""
+    with timed('search_index', 'search'):
+        ids = request.app['search_index'].search(prefix, limit=limit, after=after, exclude=current_user_id)
+    if not ids:
+        return []
+
+    async with acquire_ro(request) as conn:
+        rows = await User.filter(
+            conn=conn, filter=dict(id={'op': 'in', 'v': ids}), limit=len(ids), fields=fields,
+            current_user_id=current_user_id) or []
+    position = {uid: i for i, uid in enumerate(ids)}
+    return sorted(rows, key=lambda row: position[row['id']])
+
+
+def setup_search_index(app: web.Application):
+    """Build index in background, searches go to db until it is ready."""
+    index = app['search_index'] = UserSearchIndex()
+    subscribe(app, 'user_changed', handle_user_changed)
+
+    async def load(_app):
+        try:
+            await index.load_from_db(_app['db_ro_pool'])
+        except Exception as ex:
+            logger.exception('user search index: %r', ex)
+
+    async def start(_app):
+        _app['search_index_task'] = asyncio.create_task(load(_app))
+
+    async def stop(_app):
+        _app['search_index_task'].cancel()
+
+    app.on_startup.append(start)
+    app.on_shutdown.append(stop)
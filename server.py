@@ -1,13 +1,11 @@
 import asyncio
 import base64
-from collections import defaultdict
 import logging
 import os
 from typing import Any, Dict
 from urllib.parse import urlparse
 
 import aio_pika
-import aiofiles
 import aiohttp
 from aiohttp import web
 import aiohttp_jinja2
@@ -19,19 +17,34 @@ import aiozipkin as az
 import arq
 import asynctnt
 from cryptography import fernet
-import jinja2
 
+import api.news as api_news
 import api.user as api_user
+from broadcaster import Broadcaster
+from events import listen_events
+from events import subscribe
+from friend_graph import FRIEND_GRAPH
+from friend_graph import setup_friend_graph
 from login import check_login
 from login import handle_login_get
 from login import handle_login_post
 from login import handle_logout_post
 from login import handle_register
+from login import handle_user_changed
 from login import username_ctx_processor
+from metrics import setup_metrics
+from models.cache import LRUCache
+from models.user import User
 from news import handle_news_ws
 from news import hanlde_add_post
 from news import hanlde_newspage
 from news import listen_news_updates
+from presence import PresenceRegistry
+from search_index import setup_search_index
+from search_index import USER_SEARCH_INDEX
+from static_cache import setup_static
+from templating import setup_templates
+from userlist import handle_friend_changed
 from userlist import hanlde_add_friend
 from userlist import hanlde_del_friend
 from userlist import hanlde_userlist
@@ -44,11 +57,11 @@ TEMPLATE_DIR = 'templates'
 
 
 def handle_html(file_name):
-    async def handle_file(_: web.BaseRequest):
-        async with aiofiles.open(os.path.join(STATIC_DIR, file_name), mode="r") as file:
-            file_content = await file.read()
-        return web.Response(text=file_content, content_type="text/html")
+    async def handle_file(request: web.Request):
+        # page url is not versioned, browsers revalidate it by ETag
+        return request.app['static_cache'].response(request, file_name, max_age=0)
 
+    handle_file.__static__ = True  # type: ignore
     return handle_file
 
 
@@ -66,6 +79,22 @@ async def handle_index(request):
     return dict(session=session)
 
 
+def setup_session(app):
+    if os.getenv('SESSION_STORAGE') == 'redis' and app.get('arq_pool'):
+        # cookie keeps only session key, session data is in redis, no encryption on each request
+        from aiohttp_session.redis_storage import RedisStorage
+        storage = RedisStorage(app['arq_pool'], max_age=int(os.getenv('SESSION_MAX_AGE', 30 * 24 * 60 * 60)))
+        if os.getenv('CHAT_URL') or os.getenv('COUNTERS_URL'):
+            logging.warning('chat and counters services can not read sessions from redis storage')
+    else:
+        # secret_key must be 32 url-safe base64-encoded bytes
+        fernet_key = os.getenv('FERNET_KEY', fernet.Fernet.generate_key())
+        secret_key = base64.urlsafe_b64decode(fernet_key)
+        storage = EncryptedCookieStorage(secret_key)
+        logging.debug('fernet_key: %r secret_key: %r', fernet_key, secret_key)
+    aiohttp_session.setup(app, storage)
+
+
 async def migrate_schema(pool):
     logging.debug('migrate schema')
     conn: aiomysql.connection.Connection
@@ -110,6 +139,7 @@ async def make_app(host, port):
     app = web.Application()
     app['instance_id'] = os.getenv('INSTANCE_ID', '1')
     app['tasks'] = []
+    setup_metrics(app)
 
     jaeger_address = os.getenv('JAEGER_ADDRESS')
     az.aiohttp_helpers._set_span_properties = _set_span_properties
@@ -129,7 +159,6 @@ async def make_app(host, port):
 
     app.add_routes(
         [
-            web.static('/static', STATIC_DIR),
             web.get("/", handle_index, name='index'),
 
             web.get("/login/", handle_login_get, name='login'),
@@ -150,22 +179,12 @@ async def make_app(host, port):
             web.view("/news_ws/", handle_news_ws),
 
             web.get('/api/user/', api_user.handle_user),
+            web.get('/api/news/', api_news.handle_news),
         ]
     )
 
-    # secret_key must be 32 url-safe base64-encoded bytes
-    fernet_key = os.getenv('FERNET_KEY', fernet.Fernet.generate_key())
-    secret_key = base64.urlsafe_b64decode(fernet_key)
-    aiohttp_session.setup(app, EncryptedCookieStorage(secret_key))
-    logging.debug('fernet_key: %r secret_key: %r', fernet_key, secret_key)
-
-    app.middlewares.append(check_login)
-
-    aiohttp_jinja2.setup(
-        app,
-        loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
-        context_processors=[username_ctx_processor],
-    )
+    setup_templates(app, TEMPLATE_DIR, context_processors=[username_ctx_processor])
+    setup_static(app, STATIC_DIR)
 
     database_url = os.getenv('CLEARDB_DATABASE_URL', None) or os.getenv('DATABASE_URL', None)
 
@@ -193,6 +212,10 @@ async def make_app(host, port):
     redis_url = os.getenv('REDIS_URL', None)
     if redis_url:
         app['arq_pool'] = await arq.create_pool(arq.connections.RedisSettings.from_dsn(redis_url))
+        app['presence'] = PresenceRegistry(app['arq_pool'], app['instance_id'])
+        app['presence'].start()
+        # before the pool is closed
+        app.on_shutdown.append(lambda _app: _app['presence'].close())
 
         async def close_arq_pool(_app):
             _app['arq_pool'].close()
@@ -200,6 +223,9 @@ async def make_app(host, port):
 
         app.on_shutdown.append(close_arq_pool)
 
+    setup_session(app)
+    app.middlewares.append(check_login)
+
     tarantool_url = os.getenv('TARANTOOL_URL', None)
     if tarantool_url:
 
@@ -207,13 +233,27 @@ async def make_app(host, port):
         await app['tnt'].connect()
         app.on_shutdown.append(app['tnt'].disconnect)
 
+    User.cache = LRUCache(max_bytes=int(os.getenv('USER_CACHE_BYTES', 16 * 1024 * 1024)),
+                          ttl=float(os.getenv('USER_CACHE_TTL', 60)))
+    User.relations_cache = LRUCache(max_bytes=int(os.getenv('RELATIONS_CACHE_BYTES', 16 * 1024 * 1024)),
+                                    ttl=float(os.getenv('RELATIONS_CACHE_TTL', 30)))
+    subscribe(app, 'user_changed', handle_user_changed)
+    subscribe(app, 'friend_changed', handle_friend_changed)
+    if FRIEND_GRAPH:
+        User.friend_graph = setup_friend_graph(app)
+    if USER_SEARCH_INDEX:
+        setup_search_index(app)
+
     rabbit_url = os.getenv('CLOUDAMQP_URL', os.getenv('RABBIT_URL', None))
     if rabbit_url:
         connection: aio_pika.Connection = await aio_pika.connect_robust(rabbit_url)
         app['rabbit'] = connection  # await connection.channel()
         await start_background_task(app, listen_news_updates(app))
+        await start_background_task(app, listen_events(app))
 
-    app['news_subscribers'] = defaultdict(dict)
+    app['news_broadcaster'] = Broadcaster()
+    app['news_subscribers'] = app['news_broadcaster'].subscribers
+    app.on_shutdown.append(lambda _app: _app['news_broadcaster'].close())
 
     app.on_shutdown.append(stop_tasks)
 
@@ -0,0 +1,162 @@
+"""Static assets served from memory.
+
+Every file of the static directory is read once at startup together with its
+gzip variant (and brotli one when the `brotli` package is installed) and a
+strong ETag per variant. Requests never touch the disk: conditional ones are
+answered with 304, versioned urls from the `static_url()` template global
+(`/static/style.css?v=<content hash>`) are cached by browsers for a year.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, NamedTuple, Optional
+
+from aiohttp import web
+import aiohttp_jinja2
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('static_cache')
+
+# url changes with content, so versioned responses never go stale
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# compressed variants of smaller files save less than their headers cost
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+# preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+class Asset(NamedTuple):
+    content_type: str
+    version: str
+    # content encoding ('identity', 'gzip', 'br') -> (body, etag)
+    variants: Dict[str, tuple]
+
+
+def _compressible(content_type) -> bool:
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    # weak comparison, as If-None-Match requires
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class StaticCache:
+
+    def __init__(self, directory, prefix='/static'):
+        self.directory = directory
+        self.prefix = prefix
+        self.assets: Dict[str, Asset] = {}
+
+    def load(self):
+        assets = {}
+        size = 0
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                full_path = os.path.join(root, file_name)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, '/')
+                with open(full_path, 'rb') as file:
+                    body = file.read()
+                assets[path] = self._make_asset(path, body)
+                size += sum(len(variant) for variant, _ in assets[path].variants.values())
+        self.assets = assets
+        logger.info('static cache loaded: %d files, %d bytes with compressed variants', len(assets), size)
+
+    @staticmethod
+    def _make_asset(path, body: bytes) -> Asset:
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        digest = hashlib.sha256(body).hexdigest()
+        version = digest[:16]
+        variants = {'identity': (body, f'"{digest}"')}
+        if _compressible(content_type) and len(body) >= MIN_COMPRESS_SIZE:
+            compressed = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(body, quality=11)
+            for encoding, variant in compressed.items():
+                if len(variant) < len(body):
+                    variants[encoding] = (variant, f'"{digest}-{encoding}"')
+        return Asset(content_type, version, variants)
+
+    def url(self, path) -> str:
+        """Versioned url of asset, files missing from cache get a plain one."""
+        path = path.lstrip('/')
+        asset = self.assets.get(path)
+        if asset is None:
+            return f'{self.prefix}/{path}'
+        return f'{self.prefix}/{path}?v={asset.version}'
+
+    def response(self, request: web.Request, path, max_age: Optional[int] = None) -> web.Response:
+        """:param max_age: Cache-Control max-age, by default a year for url with current version, else revalidate"""
+        asset = self.assets.get(path)
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        encoding = 'identity'
+        if len(asset.variants) > 1:
+            accepted = _accepted_encodings(request.headers.get('Accept-Encoding', ''))
+            encoding = next((name for name in ENCODINGS if name in asset.variants and name in accepted), encoding)
+        body, etag = asset.variants[encoding]
+
+        if max_age is None:
+            max_age = STATIC_MAX_AGE if request.query.get('v') == asset.version else 0
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={max_age}, immutable' if max_age else 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+        if _etag_matches(request.headers.get('If-None-Match', ''), etag):
+            return web.Response(status=304, headers=headers)
+
+        headers['Content-Type'] = asset.content_type
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=body, headers=headers)
+
+
+async def handle_static(request: web.Request):
+    return request.app['static_cache'].response(request, request.match_info['path'])
+
+
+# check_login skips session loading for handlers of static content
+handle_static.__static__ = True  # type: ignore
+
+
+def setup_static(app: web.Application, directory, prefix='/static') -> StaticCache:
+    """Load assets, route prefix to them and expose `static_url()` to templates (set up before)."""
+    cache = app['static_cache'] = StaticCache(directory, prefix)
+    cache.load()
+    app.router.add_get(prefix + '/{path:.+}', handle_static, name='static')
+    aiohttp_jinja2.get_env(app).globals['static_url'] = cache.url
+    return cache
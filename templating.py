@@ -0,0 +1,97 @@
+"""Jinja environment of the web app.
+
+Templates are compiled once at startup, with bytecode cached on disk for the
+next start, and never reloaded unless TEMPLATE_AUTO_RELOAD is set. Post and
+user card partials, repeated for every row of news, user list and user pages,
+are rendered by `render_post`/`render_usercard` globals through an LRU cache of
+their html, keyed by entity id and version.
+"""
+import logging
+import os
+import time
+from typing import Optional
+
+from aiohttp import web
+import aiohttp_jinja2
+import jinja2
+from markupsafe import Markup
+
+from metrics import TEMPLATE_RENDER_LATENCY
+from models.cache import LRUCache
+
+logger = logging.getLogger('templating')
+
+TEMPLATE_AUTO_RELOAD = os.getenv('TEMPLATE_AUTO_RELOAD', '') in ('1', 'true', 'yes')
+# jinja picks a per-user directory in tempdir when not set
+TEMPLATE_BYTECODE_DIR = os.getenv('TEMPLATE_BYTECODE_DIR') or None
+
+# users have no version column, values shown by the card serve as one
+USERCARD_FIELDS = ('firstname', 'lastname', 'sex', 'city', 'interest')
+
+
+class TimedTemplate(jinja2.Template):
+    """Observes render time of pages and of fragments rendered on cache misses."""
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER_LATENCY.labels(self.name).observe(time.perf_counter() - started)
+
+
+def _field(obj, name):
+    # rows are dicts, current user of user page is a model
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+class FragmentCache:
+    """Rendered partials by (template, entity id, version, flags)."""
+
+    def __init__(self, env: jinja2.Environment, cache: LRUCache):
+        self.env = env
+        self.cache = cache
+
+    def render(self, template_name, key: Optional[tuple], **context) -> Markup:
+        if key is None:
+            return Markup(self.env.get_template(template_name).render(**context))
+        key = (template_name, *key)
+        html = self.cache.get(key)
+        if html is None:
+            html = self.env.get_template(template_name).render(**context)
+            self.cache.set(key, html)
+        return Markup(html)
+
+    def render_post(self, post) -> Markup:
+        post_id = _field(post, 'id')
+        # text is never edited in place, author name comes from a join
+        key = None if post_id is None else (post_id, _field(post, 'updated_at'), _field(post, 'author__name'))
+        return self.render('post.jinja2', key, post=post)
+
+    def render_usercard(self, user, link=False) -> Markup:
+        uid = _field(user, 'id') if user is not None else None
+        key = None if uid is None else (uid, bool(link), *(_field(user, name) for name in USERCARD_FIELDS))
+        return self.render('usercard.jinja2', key, user=user, link=link)
+
+
+def setup_templates(app: web.Application, template_dir, context_processors=()) -> jinja2.Environment:
+    env = aiohttp_jinja2.setup(
+        app,
+        loader=jinja2.FileSystemLoader(template_dir),
+        context_processors=list(context_processors),
+        auto_reload=TEMPLATE_AUTO_RELOAD,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_BYTECODE_DIR),
+    )
+    env.template_class = TimedTemplate
+
+    fragments = app['fragment_cache'] = FragmentCache(env, LRUCache(
+        max_bytes=int(os.getenv('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024)),
+        ttl=float(os.getenv('FRAGMENT_CACHE_TTL', 300))))
+    env.globals.update(render_post=fragments.render_post, render_usercard=fragments.render_usercard)
+
+    started = time.perf_counter()
+    names = env.list_templates(extensions=['jinja2'])
+    for name in names:
+        env.get_template(name)
+    logger.info('%d templates compiled in %.3fs', len(names), time.perf_counter() - started)
+    return env
@@ -5,8 +5,14 @@ import aiohttp_jinja2
 import aiohttp_session
 import aiomysql
 
+from db_router import acquire_ro
+from db_router import record_write
+from events import publish_event
 from login import require_login
+from metrics import timed
 from models.user import User
+from recommendations import enqueue_recompute
+from search_index import search_users
 
 PAGE_SIZE = 20
 
@@ -18,56 +24,52 @@ async def hanlde_userlist(request: web.Request):
 
     offset = int(request.rel_url.query.get('offset', 0))
     search = request.rel_url.query.get('search', '')
+    after = None
+    if request.rel_url.query.get('after'):
+        try:
+            after = User.parse_cursor(request.rel_url.query['after'])
+        except ValueError:
+            raise web.HTTPBadRequest(reason='bad cursor')
     filter = None
     if search:
         filter = {
             'firstname': {'op': 'like', 'v': f"{search}%"},
             'lastname': {'op': 'like', 'v': f"{search}%"}
         }
-    users = []
-
-    if search and request.app.get('tnt'):
-        tnt = request.app['tnt']
-        res = await tnt.call(
-            'search_with_friend_and_subscriber', [search, session['uid'], PAGE_SIZE + 1, offset])
-        if res and res[0]:
-            for row in res[0]:
-                user_tuple = row[0]
-                is_subscriber, is_friend = row[1]
-                users.append(
-                    {
-                        'id': user_tuple[0],
-                        'username': user_tuple[1],
-                        'password': user_tuple[2],
-                        'firstname': user_tuple[3],
-                        'lastname': user_tuple[4],
-                        'city': user_tuple[5],
-                        'sex': user_tuple[6],
-                        'interest': user_tuple[7],
-                        'is_subscriber': is_subscriber,
-                        'is_friend': is_friend,
-                    }
-                )
-            logging.debug('users from tarantool: %r', len(users))
+    fields = ['id', 'username', 'firstname', 'lastname', 'city', 'sex', 'interest']
+    search_index = request.app.get('search_index')
+    if search and search_index is not None and search_index.ready:
+        users = await search_users(request, search, session['uid'], limit=PAGE_SIZE + 1, after=after, fields=fields)
+        logging.debug('users from search index: %r', len(users))
+
+    elif search and request.app.get('tnt'):
+        with timed('tarantool', 'search_users'):
+            users = await User.search_tarantool(
+                request.app['tnt'], search, session['uid'], limit=PAGE_SIZE + 1, after=after, fields=fields) or []
+        logging.debug('users from tarantool: %r', len(users))
 
     else:
-        pool: aiomysql.pool.Pool = request.app['db_ro_pool']
-        async with pool.acquire() as conn:
+        async with acquire_ro(request) as conn:
             users = await User.filter(
                 filter=filter,
-                # fields=['id', 'firstname', 'lastname'],
-                fields=['id', 'username', 'password', 'firstname', 'lastname', 'city', 'sex', 'interest'],
-                limit=PAGE_SIZE + 1, offset=offset, conn=conn,
+                fields=fields,
+                limit=PAGE_SIZE + 1, offset=offset, after=after, conn=conn,
                 current_user_id=session['uid']) or []
 
             logging.debug('users from mysql: %r', len(users))
 
+    next_cursor = None
+    if len(users) > PAGE_SIZE:
+        next_cursor = User.make_cursor(users[PAGE_SIZE - 1])
+
     return dict(users=users[:PAGE_SIZE],
                 offset=offset,
                 limit=PAGE_SIZE,
                 session=session,
                 last_page=len(users) <= PAGE_SIZE,
                 search=search,
+                after=after,
+                next_cursor=next_cursor,
                 )
 
 
@@ -79,9 +81,12 @@ async def hanlde_add_friend(request: web.Request):
     async with pool.acquire() as conn:
         await User(uid=session['uid']).add_friend(friend_id=friend_id, conn=conn)
         await conn.commit()
+        await record_write(request, conn)
+    await publish_event(request.app, 'friend_changed', user_id=session['uid'], friend_id=int(friend_id), added=True)
 
     if request.app.get('arq_pool'):
-        await request.app['arq_pool'].enqueue_job('build_news_cache', user_id=session['uid'], force=True)
+        await request.app['arq_pool'].enqueue_job('feed_add_author', user_id=session['uid'], author_id=int(friend_id))
+        await enqueue_recompute(request.app['arq_pool'], session['uid'])
 
     location = request.headers.get('Referer', '/userlist/')
     return web.HTTPFound(location=location)
@@ -95,9 +100,17 @@ async def hanlde_del_friend(request: web.Request):
     async with pool.acquire() as conn:
         await User(uid=session['uid']).del_friend(friend_id=friend_id, conn=conn)
         await conn.commit()
+        await record_write(request, conn)
+    await publish_event(request.app, 'friend_changed', user_id=session['uid'], friend_id=int(friend_id), added=False)
 
     if request.app.get('arq_pool'):
-        await request.app['arq_pool'].enqueue_job('build_news_cache', user_id=session['uid'], force=True)
+        await request.app['arq_pool'].enqueue_job(
+            'feed_remove_author', user_id=session['uid'], author_id=int(friend_id))
+        await enqueue_recompute(request.app['arq_pool'], session['uid'])
 
     location = request.headers.get('Referer', '/userlist/')
     return web.HTTPFound(location=location)
+
+
+async def handle_friend_changed(app, event):
+    User.invalidate_relations(event['user_id'], event['friend_id'])
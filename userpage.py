@@ -1,4 +1,3 @@
-import asyncio
 import logging
 import os
 from urllib.parse import parse_qsl
@@ -10,13 +9,16 @@ from urllib.parse import urlunparse
 from aiohttp import web
 import aiohttp_jinja2
 import aiohttp_session
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
-import aiomysql
 import aiozipkin as az
 
+from db_router import acquire_ro
+from login import get_session_cookie
 from login import require_login
+from metrics import timed
+from models.base import Batch
 from models.post import Post
 from models.user import User
+from recommendations import get_recommendations
 
 logger = logging.getLogger(__name__)
 
@@ -37,47 +39,81 @@ async def handle_userpage(request: web.Request):
     if not current_user_uid:
         current_user_uid = uid
 
-    pool: aiomysql.pool.Pool = request.app['db_ro_pool']
-
-    async def get_friends(user):
-        async with pool.acquire() as conn:
-            return await user.get_friends(conn=conn)
-
-    async def get_subscribers(user):
-        async with pool.acquire() as conn:
-            return await user.get_subscribers(conn=conn)
-
-    async def get_user():
-        async with pool.acquire() as conn:
-            return await User.get_by_id(uid=current_user_uid, conn=conn)
-
-    async def get_posts(user):
-        async with pool.acquire() as conn:
-            return await Post.filter(filter=dict(author_id=user.id), conn=conn)
-
-    u = User(uid=current_user_uid)
-    user, friends, subscribers, posts = await asyncio.gather(
-        get_user(),
-        get_friends(user=u),
-        get_subscribers(user=u),
-        get_posts(user=u)
-    )
+    user, friends, subscribers, posts, recommended = await load_profile(
+        request, current_user_uid, with_recommendations=str(current_user_uid) == str(uid))
     counters_url = os.getenv('COUNTERS_URL')
     new_counters_url = None
     if counters_url:
-        storage: EncryptedCookieStorage = request.get(aiohttp_session.STORAGE_KEY)
-        user_session = storage.load_cookie(request)
+        user_session = get_session_cookie(request)
         new_counters_url = update_url(urljoin(counters_url, 'get_counters/'), dict(
             userId=uid,
             friends=','.join(map(lambda friend: str(friend['id']), friends)),
             session=user_session
         ))
     return dict(current_user=user, session=session, friends=friends,
-                subscribers=subscribers, posts=posts, uid=uid,
+                subscribers=subscribers, posts=posts, recommended=recommended, uid=uid,
                 chat_url=os.getenv('CHAT_URL'),
                 counters_url=new_counters_url)
 
 
+async def load_profile(request: web.Request, profile_uid, with_recommendations=False):
+    """User, friends, subscribers, posts and recommended users of profile.
+    Queries of what is missing in User.cache and User.relations_cache are sent to db
+    as one multi-statement batch, the page costs a single round trip."""
+    if not str(profile_uid).isdigit():
+        return None, [], [], [], []
+    uid = int(profile_uid)
+
+    mutual = {}
+    if with_recommendations and request.app.get('arq_pool'):
+        # precomputed by update_recommendations/build_recommendations jobs, with mutual friends count
+        with timed('redis', 'recommendations'):
+            mutual = dict(await get_recommendations(request.app['arq_pool'], uid))
+
+    batch = Batch()
+    row = User.cache.get(uid)
+    user_query = batch.add(*User.get_by_id_query(uid)) if row is None else None
+    relations = {kind: User.relations_cache.get((kind, uid)) for kind in ('friends', 'subscribers')}
+    relation_queries = {}
+    graph = User.get_friend_graph()
+    for kind, rows in relations.items():
+        if rows is not None:
+            continue
+        ids = None
+        if graph is not None:
+            # graph replaces the join and the anti-join with friend, db only orders rows by firstname
+            ids = graph.friends(uid) if kind == 'friends' else graph.subscribers(uid)
+        if ids == []:
+            relations[kind] = []
+            User.relations_cache.set((kind, uid), [])
+        else:
+            relation_queries[kind] = batch.add(*User.relations_query(uid, kind, ids=ids))
+    posts_query = batch.add(*Post.filter_query(filter=dict(author_id=uid)))
+    if mutual:
+        recommended_query = batch.add(*User.filter_query(
+            filter=dict(id={'op': 'in', 'v': list(mutual)}), limit=len(mutual)))
+    async with acquire_ro(request) as conn:
+        results = await batch.execute(conn)
+
+    if row is None:
+        if not results[user_query]:
+            return None, [], [], [], []
+        row = results[user_query][0]
+        User.cache.set(uid, row)
+    user = User.from_dict(row)
+    for kind, query in relation_queries.items():
+        relations[kind] = results[query]
+        User.relations_cache.set((kind, uid), relations[kind])
+
+    recommended = []
+    if mutual:
+        recommended = results[recommended_query]
+        for recommended_row in recommended:
+            recommended_row['mutual'] = mutual[recommended_row['id']]
+        recommended.sort(key=lambda recommended_row: (-recommended_row['mutual'], recommended_row['id']))
+    return user, relations['friends'], relations['subscribers'], results[posts_query], recommended
+
+
 def update_url(url, params):
     url_parse = urlparse(url)
     query = url_parse.query
@@ -125,8 +161,7 @@ async def handle_chat(request: web.Request):
         chat_key = await chat_api_get_key(client_session, user_id=uid, friend_id=friend_id)
         child_span.tag('chat_key', chat_key)
 
-    storage: EncryptedCookieStorage = request.get(aiohttp_session.STORAGE_KEY)
-    chat_session = storage.load_cookie(request)
+    chat_session = get_session_cookie(request)
 
     new_chat_url = update_url(chat_url, dict(
         chat_key=chat_key,
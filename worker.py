@@ -1,96 +1,300 @@
 import asyncio
 import datetime
-import json
+import functools
 import logging
 import os
 
 import aio_pika
 import aiomysql
 import arq
-
+import prometheus_client
+
+from feed import acquire_rebuild_lock
+from feed import enqueue_rebuild
+from feed import FEED_END
+from feed import fetch_posts
+from feed import follows_key
+from feed import NEWS_CACHE_SIZE
+from feed import NEWS_CACHE_TTL
+from feed import NEWS_FANOUT_CHUNK_SIZE
+from feed import NEWS_FIELDS
+from feed import news_key
+from feed import NEWS_PULL_THRESHOLD
+from feed import NEWS_TIMELINE_SIZE
+from feed import NEWS_TIMELINE_TTL
+from feed import parse_post_id
+from feed import post_sort_key
+from feed import PULL_AUTHORS_KEY
+from feed import release_rebuild_lock
+from feed import store_posts
+from feed import timeline_key
+from metrics import setup_state_collector
+from metrics import timed_job
+from metrics import update_queue_depth
 from models.friend import Friend
 from models.post import Post
+from publisher import NewsPublisher
+from recommendations import AdjacencySnapshot
+from recommendations import compute_batch
+from recommendations import RECS_BATCH_SIZE
+from recommendations import RECS_BUILD_HOUR
+from recommendations import RECS_FANOUT_MAX
+from recommendations import RECS_OVERLAY_MAX
+from recommendations import RECS_SNAPSHOT_MAX_AGE
+from recommendations import store_recommendations
 from server import close_db_pool
 from server import extract_database_credentials
-from utils import default
-
-# NEWS_CACHE_SIZE = 1000
-NEWS_CACHE_SIZE = 3
-NEWS_CACHE_TTL = 300
-NEWS_CACHE_SUBSCRIBERS_LIMIT = 20
 
 
 async def build_news_cache(ctx, user_id, force=False):
     logging.debug(f'build_cache user_id={user_id}...')
     pool: aiomysql.pool.Pool = ctx['db_ro_pool']
     redis = ctx['arq_pool']
-    key = f'news:{user_id}'
+    key = news_key(user_id)
     if not force and await redis.llen(key):
         return 'build_cache skiped'
 
+    lock_token = await acquire_rebuild_lock(redis, user_id)
+    if not lock_token:
+        return 'build_cache in progress'
+
+    try:
+        async with pool.acquire() as conn:
+            posts = await Post.filter(
+                conn=conn, filter=dict(post_of_friends=user_id),
+                fields=NEWS_FIELDS,
+                limit=NEWS_CACHE_SIZE)
+            pipe = redis.pipeline()
+
+            pipe.delete(key)
+            store_posts(pipe, posts)
+            for post in posts:
+                pipe.rpush(key, post['id'])
+            if len(posts) < NEWS_CACHE_SIZE:
+                # whole feed, an empty one too, readers do not go to db or enqueue rebuilds past it
+                pipe.rpush(key, FEED_END)
+
+            pipe.ltrim(key, 0, NEWS_CACHE_SIZE - 1)
+            pipe.expire(key, NEWS_CACHE_TTL)
+
+            # followed authors, to pick up timelines of pull authors on read
+            pipe.delete(follows_key(user_id))
+            async for friend_ids in Friend.iter_friend_ids(conn, user_id=user_id):
+                pipe.sadd(follows_key(user_id), *friend_ids)
+            pipe.expire(follows_key(user_id), NEWS_CACHE_TTL)
+            await pipe.execute()
+    finally:
+        await release_rebuild_lock(redis, user_id, lock_token)
+
+    return 'build_cache done'
+
+
+async def is_following(ctx, user_id, author_id):
+    # jobs of one user may run out of order, primary tells the latest state
+    pool: aiomysql.pool.Pool = ctx['db_pool']
     async with pool.acquire() as conn:
-        posts = await Post.filter(
-            conn=conn, filter=dict(post_of_friends=user_id),
-            fields=['author__name', 'id', 'author_id', 'text', 'created_at', 'updated_at'], limit=NEWS_CACHE_SIZE)
-        pipe = redis.pipeline()
+        return bool(await Friend.count(conn, filter=dict(user_id=user_id, friend_id=author_id)))
 
-        pipe.delete(key)
-        for post in posts:
-            post_json = json.dumps(post, default=default)
-            pipe.rpush(key, post_json)
 
-        pipe.ltrim(key, 0, NEWS_CACHE_SIZE - 1)
-        pipe.expire(key, NEWS_CACHE_TTL)
+async def load_posts_by_ids(ctx, post_ids):
+    pool: aiomysql.pool.Pool = ctx['db_ro_pool']
+    async with pool.acquire() as conn:
+        return await Post.filter(
+            conn=conn, filter=dict(id={'op': 'in', 'v': post_ids}), limit=len(post_ids),
+            fields=NEWS_FIELDS)
+
+
+async def feed_add_author(ctx, user_id, author_id):
+    """Merge recent posts of newly followed author into cached feed of user_id."""
+    logging.debug(f'feed_add_author user_id={user_id} author_id={author_id}...')
+    redis = ctx['arq_pool']
+    lock_token = await acquire_rebuild_lock(redis, user_id)
+    if not lock_token:
+        raise arq.worker.Retry(defer=1)
+
+    try:
+        if not await is_following(ctx, user_id, author_id):
+            return 'feed_add_author skiped'
+
+        key = news_key(user_id)
+        pipe = redis.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.exists(follows_key(user_id))
+        pipe.sismember(PULL_AUTHORS_KEY, author_id)
+        news_entries, has_follows, is_pull_author = await pipe.execute()
+
+        pipe = redis.pipeline()
+        if has_follows:
+            # cold follows set is rebuilt whole, partial one would hide other pull authors
+            pipe.sadd(follows_key(user_id), author_id)
+
+        # cold feed is built from db on read; posts of pull authors are merged on read from timeline
+        if news_entries and not is_pull_author:
+            cached_ids = list(map(parse_post_id, news_entries))
+            entries = dict(zip(cached_ids, news_entries))
+            complete = cached_ids[-1] == FEED_END
+            if complete:
+                cached_ids.pop()
+            cached = {}
+            if cached_ids:
+                cached = await fetch_posts(redis, cached_ids, functools.partial(load_posts_by_ids, ctx))
+            cached_posts = [cached[post_id] for post_id in cached_ids if post_id in cached]
+
+            pool: aiomysql.pool.Pool = ctx['db_ro_pool']
+            async with pool.acquire() as conn:
+                author_posts = await Post.filter(
+                    conn=conn, filter=dict(author_id=author_id),
+                    fields=NEWS_FIELDS,
+                    limit=NEWS_CACHE_SIZE)
+
+            # cache keeps a prefix of the feed, older posts are read from db past it,
+            # unless it holds the whole feed
+            oldest = post_sort_key(cached_posts[-1]) if cached_posts else None
+            new_posts = [post for post in author_posts
+                         if post['id'] not in cached and (complete or oldest and post_sort_key(post) > oldest)]
+            store_posts(pipe, new_posts)
+            for post in new_posts:
+                # LINSERT keeps positions relative to posts pushed to the head meanwhile
+                pivot = next((cached_post['id'] for cached_post in cached_posts
+                              if post_sort_key(cached_post) < post_sort_key(post)), FEED_END)
+                pipe.linsert(key, entries[pivot], post['id'], before=True)
+            pipe.ltrim(key, 0, NEWS_CACHE_SIZE - 1)
         await pipe.execute()
+    finally:
+        await release_rebuild_lock(redis, user_id, lock_token)
 
-    return 'build_cache done'
+    return 'feed_add_author done'
 
 
-async def send_post_to_subscriber(ctx, post, subscriber_id):
-    logging.debug('send_post_to_subscriber %r %r', post, subscriber_id)
-    rabbit: aio_pika.Connection = ctx.get('rabbit')
-    redis: arq.ArqRedis = ctx['arq_pool']
-    if not rabbit:
-        return
+async def feed_remove_author(ctx, user_id, author_id):
+    """Filter posts of unfollowed author out of cached feed of user_id."""
+    logging.debug(f'feed_remove_author user_id={user_id} author_id={author_id}...')
+    redis = ctx['arq_pool']
+    lock_token = await acquire_rebuild_lock(redis, user_id)
+    if not lock_token:
+        raise arq.worker.Retry(defer=1)
 
-    for instance_id in await redis.smembers(f'news:{subscriber_id}:instances'):
-        channel = await rabbit.channel()
-        exchange = await channel.get_exchange('news')
-        msg: aio_pika.Message = aio_pika.Message(
-            body=json.dumps(dict(post, subscriber_id=subscriber_id), default=default).encode(),
-            content_type='application/json')
-        await exchange.publish(msg, routing_key=instance_id)
-        logging.debug('publish post %r to ex: %r with routing_key: %r', post, exchange, instance_id)
+    try:
+        if await is_following(ctx, user_id, author_id):
+            return 'feed_remove_author skiped'
+
+        key = news_key(user_id)
+        pipe = redis.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.srem(follows_key(user_id), author_id)
+        news_entries, _ = await pipe.execute()
+        cached_ids = list(map(parse_post_id, news_entries))
+        post_ids = [post_id for post_id in cached_ids if post_id != FEED_END]
+        if not post_ids:
+            return 'feed_remove_author done'
+
+        cached = await fetch_posts(redis, post_ids, functools.partial(load_posts_by_ids, ctx))
+        pipe = redis.pipeline()
+        for entry, post_id in zip(news_entries, cached_ids):
+            if post_id in cached and cached[post_id]['author_id'] == int(author_id):
+                pipe.lrem(key, 0, entry)
+        await pipe.execute()
+    finally:
+        await release_rebuild_lock(redis, user_id, lock_token)
+
+    return 'feed_remove_author done'
 
 
-async def add_post_to_cache(ctx, post_id):
+async def add_post_to_cache(ctx, post_id, post: dict = None):
     logging.debug(f'add_post_to_cache post_id={post_id}...')
-    pool: aiomysql.pool.Pool = ctx['db_pool']
+    if post is None:
+        # job enqueued without payload
+        pool: aiomysql.pool.Pool = ctx['db_pool']
+        async with pool.acquire() as conn:
+            post = (await Post.filter(
+                filter={'id': post_id}, conn=conn,
+                fields=NEWS_FIELDS))[0]
+
+    redis = ctx['arq_pool']
+    pool: aiomysql.pool.Pool = ctx['db_ro_pool']
     async with pool.acquire() as conn:
-        post: dict = (await Post.filter(
-            filter={'id': post_id}, conn=conn,
-            fields=['author__name', 'id', 'author_id', 'text', 'created_at', 'updated_at']))[0]
-        post_json = json.dumps(post, default=default)
-        redis = ctx['arq_pool']
-        for subscriber in await Friend.filter(
-                conn=conn,
-                filter=dict(friend_id=post['author_id']),
-                fields=['user_id'], limit=NEWS_CACHE_SUBSCRIBERS_LIMIT):
-            pipe = redis.pipeline()
-            key = f'news:{subscriber["user_id"]}'
-            if await redis.llen(key):
-                pipe.lpush(key, post_json)
+        # counting stops past the threshold, authors with millions of subscribers are not scanned
+        pull = await Friend.count(
+            conn, filter=dict(friend_id=post['author_id']), limit=NEWS_PULL_THRESHOLD + 1) > NEWS_PULL_THRESHOLD
+        pipe = redis.pipeline()
+        store_posts(pipe, [post])
+        if pull:
+            pipe.sadd(PULL_AUTHORS_KEY, post['author_id'])
+            pipe.lpush(timeline_key(post['author_id']), post['id'])
+            pipe.ltrim(timeline_key(post['author_id']), 0, NEWS_TIMELINE_SIZE - 1)
+            pipe.expire(timeline_key(post['author_id']), NEWS_TIMELINE_TTL)
+        else:
+            pipe.srem(PULL_AUTHORS_KEY, post['author_id'])
+        await pipe.execute()
 
-                pipe.ltrim(key, 0, NEWS_CACHE_SIZE - 1)
-                pipe.expire(key, NEWS_CACHE_TTL)
+        async for subscriber_ids in Friend.iter_subscriber_ids(
+                conn, friend_id=post['author_id'], chunk_size=NEWS_FANOUT_CHUNK_SIZE):
+            if not pull:
+                pipe = redis.pipeline()
+                for subscriber_id in subscriber_ids:
+                    key = news_key(subscriber_id)
+                    # LPUSHX skips cold caches, they are built from db on login
+                    pipe.lpushx(key, post['id'])
+                    pipe.ltrim(key, 0, NEWS_CACHE_SIZE - 1)
+                    pipe.expire(key, NEWS_CACHE_TTL)
+                    pipe.expire(follows_key(subscriber_id), NEWS_CACHE_TTL)
                 await pipe.execute()
-            else:
-                await build_news_cache(ctx, subscriber["user_id"])
 
-            await send_post_to_subscriber(ctx, post, subscriber_id=subscriber["user_id"])
+            if ctx.get('news_publisher'):
+                await ctx['news_publisher'].publish(post, subscriber_ids)
     return 'add_post_to_cache done'
 
 
+async def get_recs_snapshot(ctx, reload=False) -> AdjacencySnapshot:
+    # jobs of one worker share the snapshot, only one of them loads it
+    async with ctx['recs_snapshot_lock']:
+        snapshot = ctx.get('recs_snapshot')
+        if (reload or snapshot is None or snapshot.age > RECS_SNAPSHOT_MAX_AGE
+                or len(snapshot.overlay) > RECS_OVERLAY_MAX):
+            snapshot = ctx['recs_snapshot'] = await AdjacencySnapshot.load_from_db(ctx['db_ro_pool'])
+    return snapshot
+
+
+async def build_recommendations(ctx):
+    """Recompute recommendations of every user with friends on a fresh snapshot."""
+    snapshot = await get_recs_snapshot(ctx, reload=True)
+    redis = ctx['arq_pool']
+    loop = asyncio.get_event_loop()
+    users = 0
+    for start in range(0, snapshot.nodes, RECS_BATCH_SIZE):
+        uids = snapshot.users_with_friends(start, start + RECS_BATCH_SIZE)
+        # numpy releases GIL on large arrays, the loop keeps job heartbeats going meanwhile
+        recs = await loop.run_in_executor(None, compute_batch, snapshot, uids)
+        pipe = redis.pipeline()
+        store_recommendations(pipe, recs)
+        await pipe.execute()
+        users += len(recs)
+    return f'build_recommendations done: {users} users'
+
+
+async def update_recommendations(ctx, user_id):
+    """Recompute recommendations of user_id and its followers after friends of user_id changed."""
+    snapshot = await get_recs_snapshot(ctx)
+    # replica may not have the change yet
+    pool: aiomysql.pool.Pool = ctx['db_pool']
+    async with pool.acquire() as conn:
+        friend_ids = [friend_id async for chunk in Friend.iter_friend_ids(conn, user_id=user_id) for friend_id in chunk]
+        follower_ids = []
+        async for chunk in Friend.iter_subscriber_ids(conn, friend_id=user_id):
+            follower_ids.extend(chunk)
+            if len(follower_ids) >= RECS_FANOUT_MAX:
+                break
+    snapshot.set_friends(user_id, friend_ids)
+
+    loop = asyncio.get_event_loop()
+    recs = await loop.run_in_executor(
+        None, compute_batch, snapshot, [int(user_id)] + follower_ids[:RECS_FANOUT_MAX])
+    pipe = ctx['arq_pool'].pipeline()
+    store_recommendations(pipe, recs)
+    await pipe.execute()
+    return 'update_recommendations done'
+
+
 async def startup(ctx):
     logging.basicConfig(level=logging.DEBUG)
     database_url = os.getenv('CLEARDB_DATABASE_URL', None) or os.getenv('DATABASE_URL', None)
@@ -99,6 +303,7 @@ async def startup(ctx):
         maxsize=50,
         autocommit=True)
     ctx['db_pool'] = pool
+    ctx['recs_snapshot_lock'] = asyncio.Lock()
 
     databse_ro_url = os.getenv('DATABASE_RO_URL', None)
     if databse_ro_url:
@@ -123,20 +328,41 @@ async def startup(ctx):
         # async with connection:  closes connection
         channel = await connection.channel()
         await channel.declare_exchange("news", durable=True)
+        await channel.close()
+        ctx['news_publisher'] = NewsPublisher(connection, ctx['arq_pool'])
+
+    setup_state_collector(ctx)
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        prometheus_client.start_http_server(int(metrics_port))
+        ctx['queue_depth_task'] = asyncio.create_task(watch_queue_depth(ctx['arq_pool']))
+
+
+async def watch_queue_depth(redis, interval=5):
+    while True:
+        await update_queue_depth(redis)
+        await asyncio.sleep(interval)
 
 
 async def shutdown(ctx):
+    if ctx.get('queue_depth_task'):
+        ctx['queue_depth_task'].cancel()
 
     if ctx['db_pool'] == ctx['db_ro_pool']:
         await close_db_pool(ctx['db_ro_pool'])
     await close_db_pool(ctx['db_pool'])
 
+    if ctx.get('news_publisher'):
+        await ctx['news_publisher'].close()
     if ctx.get('rabbit'):
         await ctx['rabbit'].close()
 
 
 class WorkerSettings:
-    functions = [build_news_cache, add_post_to_cache]
+    functions = [timed_job(build_news_cache), timed_job(add_post_to_cache),
+                 timed_job(feed_add_author), timed_job(feed_remove_author),
+                 timed_job(update_recommendations)]
+    cron_jobs = [arq.cron(timed_job(build_recommendations), hour={RECS_BUILD_HOUR}, minute={0}, timeout=60 * 60)]
     on_startup = startup
     on_shutdown = shutdown
     redis_settings = arq.connections.RedisSettings.from_dsn(os.getenv('REDIS_URL', None))
@@ -146,7 +372,7 @@ async def main():
     redis_url = os.getenv('REDIS_URL', None)
     arq_pool = await arq.create_pool(arq.connections.RedisSettings.from_dsn(redis_url))
     user_id = os.getenv('USER_ID', 1001004)
-    await arq_pool.enqueue_job('build_news_cache', user_id)
+    await enqueue_rebuild(arq_pool, user_id)
     arq_pool.close()
 
 
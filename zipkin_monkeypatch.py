@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aiohttp.web_request import Request
 from aiozipkin import HTTP_METHOD
 from aiozipkin import HTTP_PATH
@@ -7,6 +9,14 @@ from aiozipkin import SpanAbc
 from aiozipkin.aiohttp_helpers import _set_remote_endpoint
 
 
+def get_route(request: Request) -> Optional[str]:
+    """Canonical route like /userpage/{uid}/, None when not matched."""
+    resource = request.match_info.route.resource
+    if resource is not None:
+        return resource.canonical
+    return None
+
+
 def _set_span_properties(span: SpanAbc, request: Request) -> None:
     span_name = f"{request.method.upper()} {request.path}"
     span.name(span_name)
@@ -14,9 +24,8 @@ def _set_span_properties(span: SpanAbc, request: Request) -> None:
     span.tag(HTTP_PATH, request.path)
     span.tag(HTTP_METHOD, request.method.upper())
 
-    resource = request.match_info.route.resource
-    if resource is not None:
-        route = resource.canonical
+    route = get_route(request)
+    if route is not None:
         span.tag(HTTP_ROUTE, route)
 
     _set_remote_endpoint(span, request)